@@ -0,0 +1,192 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest
+from telegram.error import RetryAfter
+
+from config import config
+from database import Asset
+import utils as u
+
+logger = logging.getLogger(__name__)
+
+MAX_DOWNLOADS = config.jobs.github.get('assets_max_downloads', 3)
+MAX_RELEASES = config.jobs.github.get('assets_max_releases', 2)
+MAX_DISK_BYTES = config.jobs.github.get('assets_max_disk_mb', 500) * 1024 * 1024
+MAX_ATTEMPTS = config.jobs.github.get('assets_max_attempts', 3)
+
+# seconds to wait before retrying a failed transfer, multiplied by the attempt number
+RETRY_DELAY = 10
+
+# downloads have their own pool: they can be long, and they must not take the slots of the polling tasks
+download_executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOADS, thread_name_prefix='assets')
+
+# the releases whose assets are being sent wait on their downloads and uploads: they don't take the polling slots
+# either, and can't share the downloads pool they wait on
+release_executor = ThreadPoolExecutor(max_workers=MAX_RELEASES, thread_name_prefix='assets-release')
+
+
+class DiskBudget:
+    """Bytes that can be on disk in downloads/ at the same time, shared by all the releases being processed.
+    A file bigger than the whole budget is allowed only when nothing else is on disk"""
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._used = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, size):
+        return self._used == 0 or self._used + size <= self._max_bytes
+
+    def acquire(self, size, blocking=True):
+        with self._condition:
+            while not self._fits(size):
+                if not blocking:
+                    return False
+                self._condition.wait()
+
+            self._used += size
+            return True
+
+    def release(self, size):
+        with self._condition:
+            self._used -= size
+            self._condition.notify_all()
+
+
+disk_budget = DiskBudget(MAX_DISK_BYTES)
+
+
+def _retry(description, func, *args):
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return func(*args)
+        except BadRequest:
+            # the request itself is wrong (e.g. file too big, invalid file_id): retrying won't help
+            raise
+        except RetryAfter as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            logger.warning('%s: flood wait of %d seconds (attempt %d)', description, e.retry_after, attempt)
+            time.sleep(e.retry_after)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            logger.warning('%s failed (attempt %d): %s', description, attempt, str(e))
+            time.sleep(RETRY_DELAY * attempt)
+
+
+def _remove(file_path):
+    for path in (file_path, file_path + '.part'):
+        if os.path.isfile(path):
+            logger.info('removing file %s...', path)
+            os.remove(path)
+
+
+def _download(asset, file_name):
+    # a failed attempt leaves the .part file: the next one only downloads the missing bytes
+    return _retry('download of {}'.format(asset.name), u.download_to_file, asset.browser_download_url, file_name, asset.size)
+
+
+def _send_file_id(send, asset, cached):
+    """Send an asset already uploaded by its file_id. Returns False if Telegram doesn't accept the file_id"""
+
+    logger.info('asset %s already uploaded, sending it by file_id', asset.name)
+    try:
+        _retry('sending of {}'.format(asset.name), send, asset, cached.file_id, cached.md5, cached.sha1)
+    except BadRequest as e:
+        logger.warning('file_id of asset %s not valid anymore: %s', asset.name, str(e))
+        Asset.forget_file_id(cached.file_id)
+        return False
+
+    if cached.asset_id != asset.id:
+        Asset.save_upload(asset, cached.md5, cached.sha1, cached.file_id)
+
+    return True
+
+
+def _upload(send, asset, file_path, md5, sha1):
+    # the same content could have been uploaded for another asset
+    cached = Asset.get_uploaded_content(sha1, asset.size)
+    if cached and _send_file_id(send, asset, cached):
+        return
+
+    def upload():
+        with open(file_path, 'rb') as f:
+            return send(asset, f, md5, sha1)
+
+    logger.info('uploading asset %s...', asset.name)
+    message = _retry('upload of {}'.format(asset.name), upload)
+    if message and message.document:
+        Asset.save_upload(asset, md5, sha1, message.document.file_id)
+
+
+class PendingAsset:
+    def __init__(self, asset, file_path, cached=None, download=None):
+        self.asset = asset
+        self.file_path = file_path
+        self.cached = cached
+        self.download = download
+
+
+def send_assets(assets, send, file_prefix=''):
+    """Download the assets and pass them to send(asset, document, md5, sha1), which is expected to send the
+    document (an open file, or the file_id of an already uploaded file) and return the sent message.
+
+    Assets already uploaded are sent by their file_id, without downloading them: the cache is keyed by the
+    asset id/size/updated_at and, once downloaded, by the sha1 of the file.
+    Up to MAX_DOWNLOADS assets are downloaded at the same time (md5 and sha1 are computed while downloading),
+    while the ones already on disk are sent in the original order. Files are deleted as soon as they are sent,
+    and new downloads wait when the disk budget is used up.
+    Every download and upload is retried up to MAX_ATTEMPTS times: an asset that keeps failing is skipped
+    without affecting the others. Returns the list of the assets that could not be sent"""
+
+    pending = deque()
+    failed = []
+
+    def send_oldest():
+        item = pending.popleft()
+        asset = item.asset
+        try:
+            if item.cached:
+                if _send_file_id(send, asset, item.cached):
+                    return
+
+                # rare: download it now, without waiting for the disk budget
+                item.download = download_executor.submit(_download, asset, os.path.basename(item.file_path))
+
+            _, md5, sha1 = item.download.result()
+            _upload(send, asset, item.file_path, md5, sha1)
+        except Exception as e:
+            logger.error('error while processing asset %s: %s', asset.name, str(e), exc_info=True)
+            failed.append(asset)
+        finally:
+            _remove(item.file_path)
+            if not item.cached:
+                disk_budget.release(asset.size)
+
+    for asset in assets:
+        # files of different releases are in downloads/ at the same time: the prefix avoids name clashes
+        file_path = os.path.join('downloads', file_prefix + asset.name)
+
+        cached = Asset.get_uploaded(asset)
+        if cached:
+            pending.append(PendingAsset(asset, file_path, cached=cached))
+            continue
+
+        # don't wait for other releases' files while ours can be sent to make room
+        while not disk_budget.acquire(asset.size, blocking=not pending):
+            send_oldest()
+
+        logger.info('downloading asset %s...', asset.name)
+        download = download_executor.submit(_download, asset, file_prefix + asset.name)
+        pending.append(PendingAsset(asset, file_path, download=download))
+
+    while pending:
+        send_oldest()
+
+    return failed
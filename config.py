@@ -1,5 +1,9 @@
+import logging
+
 import toml
 
+logger = logging.getLogger(__name__)
+
 
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
@@ -7,8 +11,65 @@ class AttrDict(dict):
         self.__dict__ = self
 
 
+def _as_list(value):
+    # chat_id/room_id can be a single value, a list, or 0/false to disable the destination
+    if not value:
+        return []
+
+    return [item for item in value if item] if isinstance(value, list) else [value]
+
+
+# settings that can differ between entries with the same path
+DESTINATION_KEYS = ('chat_id', 'room_id')
+
+
+def _settings(repo_data):
+    return {key: value for key, value in repo_data.items() if key not in DESTINATION_KEYS}
+
+
+def group_repos(repos_config):
+    """Set chat_ids and room_ids (lists) on every repo, and merge the entries with the same path: the repo is
+    polled and rendered once, and posted in the destinations of all the entries. Entries with the same path
+    must have the same settings (branch, hashtag...), otherwise they would be rendered differently: a ValueError
+    is raised if they don't"""
+
+    grouped = {}
+    first_by_path = {}
+    for repo_desc, repo_data in repos_config.repos.items():
+        if config.jobs.github.get('test_chat_id', 0):
+            chat_ids = [config.jobs.github.test_chat_id] if _as_list(repo_data.get('chat_id', None)) else []
+        else:
+            chat_ids = _as_list(repo_data.get('chat_id', None))
+        room_ids = _as_list(repo_data.get('room_id', None))
+
+        if repo_data.path not in first_by_path:
+            settings = _settings(repo_data)
+            repo_data.chat_ids, repo_data.room_ids = chat_ids, room_ids
+            first_by_path[repo_data.path] = (repo_desc, settings, repo_data)
+            grouped[repo_desc] = repo_data
+            continue
+
+        first_desc, first_settings, first = first_by_path[repo_data.path]
+        settings = _settings(repo_data)
+        if settings != first_settings:
+            different = sorted(key for key in set(settings) | set(first_settings)
+                               if settings.get(key, None) != first_settings.get(key, None))
+            raise ValueError('repos {} and {} have the same path ({}) but different settings: {}. Entries with the '
+                             'same path can only have different chat_id/room_id'.format(
+                                 first_desc, repo_desc, repo_data.path, ', '.join(different)))
+
+        logger.info('repo %s has the same path of %s (%s): merging their destinations', repo_desc, first_desc,
+                    repo_data.path)
+        first.chat_ids.extend(chat_id for chat_id in chat_ids if chat_id not in first.chat_ids)
+        first.room_ids.extend(room_id for room_id in room_ids if room_id not in first.room_ids)
+
+    repos_config.repos = AttrDict(grouped)
+
+
 config = toml.load('config.toml', AttrDict)
 try:
     repos = toml.load('repos.toml', AttrDict)
 except FileNotFoundError:
     repos = toml.load('repos.default.toml', AttrDict)
+
+group_repos(repos)
@@ -0,0 +1,118 @@
+import logging
+import threading
+from collections import Counter
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.connectionpool import HTTPSConnectionPool
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+http_config = config.get('http', {})
+
+POOL_CONNECTIONS = http_config.get('pool_connections', 10)
+POOL_MAXSIZE = http_config.get('pool_maxsize', 10)
+TIMEOUT = http_config.get('timeout', 60)
+MAX_RETRIES = http_config.get('max_retries', 2)
+
+
+class PoolMetrics:
+    """Per-host count of the connections taken from the pools: a hit reuses a kept-alive connection,
+    a miss opens a new one (TCP + TLS handshake)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._misses = Counter()
+
+    def request(self, host):
+        with self._lock:
+            self._requests[host] += 1
+
+    def miss(self, host):
+        with self._lock:
+            self._misses[host] += 1
+
+    def snapshot(self):
+        """Returns a dict host -> (hits, misses)"""
+
+        with self._lock:
+            return {host: (count - self._misses[host], self._misses[host]) for host, count in self._requests.items()}
+
+    def __str__(self):
+        lines = ['{}: {} hits, {} misses'.format(host, hits, misses) for host, (hits, misses) in sorted(self.snapshot().items())]
+        return '\n'.join(lines) or 'no requests yet'
+
+
+pool_metrics = PoolMetrics()
+
+
+class _CountingPool:
+    def _get_conn(self, timeout=None):
+        pool_metrics.request(self.host)
+        return super(_CountingPool, self)._get_conn(timeout=timeout)
+
+    def _new_conn(self):
+        pool_metrics.miss(self.host)
+        return super(_CountingPool, self)._new_conn()
+
+
+class CountingHTTPConnectionPool(_CountingPool, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPool, HTTPSConnectionPool):
+    pass
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout, whose pools report to pool_metrics"""
+
+    def __init__(self, timeout=TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super(PooledAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            http=CountingHTTPConnectionPool,
+            https=CountingHTTPSConnectionPool
+        )
+
+    def send(self, request, timeout=None, **kwargs):
+        return super(PooledAdapter, self).send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def _build_adapters():
+    adapters = {}
+
+    default_adapter = PooledAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES)
+    adapters['http://'] = default_adapter
+    adapters['https://'] = default_adapter
+
+    # hosts with their own pool size, e.g. the GitHub API polled by many threads at once
+    for host, pool_maxsize in http_config.get('hosts', {}).items():
+        adapters['https://{}/'.format(host)] = PooledAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=MAX_RETRIES)
+
+    return adapters
+
+
+# shared by every session, so all the requests to a host go through the same pool
+_adapters = _build_adapters()
+
+
+def new_session():
+    """A requests.Session backed by the shared pools. Use it when the session needs its own headers or
+    authentication, otherwise use the shared `session`"""
+
+    new = requests.Session()
+    for prefix, adapter in _adapters.items():
+        new.mount(prefix, adapter)
+
+    return new
+
+
+session = new_session()
@@ -1,13 +1,34 @@
+import logging
+
 from peewee import DoesNotExist
 
 from .models import db
+from .models import BINARY_SHAS
+from .models import write_transaction
 from .models import Commit
 from .models import Release
+from .models import HttpValidator
+from .models import BranchHead
+from .models import Asset
+from .models import OutboxMessage
+from .models import OutboxStatus
+from .seen import seen_commits
+from .migrations import run_migrations
+from . import maintenance
+
+logger = logging.getLogger(__name__)
 
 
 def create_tables():
     with db:
-        db.create_tables([Commit, Release])
+        # existing tables first, then the missing tables are created with the current schema
+        run_migrations(db)
+        db.create_tables([Commit, Release, HttpValidator, BranchHead, Asset, OutboxMessage])
+
+    # database.binary_shas has been changed since the last run
+    converted = Commit.convert_shas()
+    if converted:
+        logger.info('%d commits shas converted to the %s format', converted, 'binary' if BINARY_SHAS else 'text')
 
 
 create_tables()
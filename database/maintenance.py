@@ -0,0 +1,135 @@
+import logging
+import os
+from datetime import datetime
+from datetime import timedelta
+
+import peewee
+
+from config import config
+from .models import db
+from .models import write_transaction
+from .models import Commit
+from .models import OutboxMessage
+from .models import OutboxStatus
+
+logger = logging.getLogger(__name__)
+
+# commits older than the commits window can't be listed again, so they don't need to be remembered. Keep some
+# margin: a commit pushed today can be dated a few days ago
+RETENTION_DAYS = max(config.database.get('retention_days', 30), config.jobs.github.commits_days_backwards * 2)
+
+# rows deleted per transaction, so the jobs don't wait for the write lock too long
+DELETE_BATCH = 5000
+
+# vacuum when at least this fraction of the file is free pages
+VACUUM_FREE_RATIO = 0.2
+
+
+def retention_horizon():
+    """Pruned commits are not in the db anymore, so the commits dated before this (UTC) can't be told apart from new
+    ones. A commit is saved after its date, so a pruned commit is always older than this"""
+
+    return datetime.utcnow() - timedelta(days=RETENTION_DAYS)
+
+
+def _delete_old(model, where):
+    table = model._meta.table_name
+    deleted = 0
+    while True:
+        with write_transaction():
+            count = db.execute_sql(
+                'DELETE FROM "{0}" WHERE rowid IN (SELECT rowid FROM "{0}" WHERE {1} LIMIT {2:d})'.format(
+                    table, where, DELETE_BATCH
+                ),
+                (str(datetime.now() - timedelta(days=RETENTION_DAYS)),)
+            ).rowcount
+
+        deleted += count
+        if count < DELETE_BATCH:
+            return deleted
+
+
+def prune():
+    """Delete the commits and the delivered (or failed) outbox messages older than the retention period.
+    Returns a dict table -> deleted rows"""
+
+    deleted = {
+        # the in-memory seen index can still have some of them, which is fine: they have been seen
+        'Commits': _delete_old(Commit, '"added_on" < ?'),
+        # pending messages are never deleted. The others are only needed to not enqueue them again
+        'Outbox': _delete_old(OutboxMessage, '"status" != \'{}\' AND "added_on" < ?'.format(OutboxStatus.PENDING)),
+    }
+    logger.info('pruned rows older than %d days: %s', RETENTION_DAYS, deleted)
+
+    return deleted
+
+
+def checkpoint():
+    """Copy the wal file into the db file and truncate it (e.g. before sending the db file). Returns False if it
+    couldn't be completed because other connections are using the wal"""
+
+    busy, _, _ = db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return not busy
+
+
+def vacuum(force=False):
+    """Rebuild the db file if enough space is unused. Returns whether it has been rebuilt"""
+
+    page_count = db.execute_sql('PRAGMA page_count').fetchone()[0]
+    freelist_count = db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+    if not force and freelist_count < page_count * VACUUM_FREE_RATIO:
+        logger.info('%d free pages out of %d: no need to vacuum', freelist_count, page_count)
+        return False
+
+    logger.info('%d free pages out of %d: vacuuming...', freelist_count, page_count)
+    db.execute_sql('VACUUM')
+
+    return True
+
+
+def file_sizes():
+    """Returns the size in bytes of the db file and of its wal file"""
+
+    sizes = []
+    for path in (config.database.filename, config.database.filename + '-wal'):
+        sizes.append(os.path.getsize(path) if os.path.isfile(path) else 0)
+
+    return tuple(sizes)
+
+
+def table_sizes():
+    """Returns a dict table -> (rows, bytes used by the table and its indexes). Bytes are None if sqlite is
+    compiled without the dbstat table"""
+
+    table_bytes = None
+    try:
+        query = 'SELECT m.tbl_name, SUM(s.pgsize) FROM dbstat AS s JOIN sqlite_master AS m ON s.name = m.name GROUP BY m.tbl_name'
+        table_bytes = dict(db.execute_sql(query).fetchall())
+    except peewee.OperationalError:
+        pass
+
+    sizes = {}
+    for table in db.get_tables():
+        rows = db.execute_sql('SELECT COUNT(*) FROM "{}"'.format(table)).fetchone()[0]
+        sizes[table] = (rows, table_bytes.get(table, 0) if table_bytes is not None else None)
+
+    return sizes
+
+
+def report():
+    db_size, wal_size = file_sizes()
+    lines = ['file: {:.1f} MB, wal: {:.1f} MB'.format(db_size / 1024 / 1024, wal_size / 1024 / 1024)]
+    for table, (rows, size) in sorted(table_sizes().items()):
+        if size is None:
+            lines.append('{}: {} rows'.format(table, rows))
+        else:
+            lines.append('{}: {} rows, {:.1f} MB'.format(table, rows, size / 1024 / 1024))
+
+    return '\n'.join(lines)
+
+
+def run_maintenance():
+    prune()
+    vacuum()
+    checkpoint()
+    logger.info('database after the maintenance:\n%s', report())
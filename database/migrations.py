@@ -5,52 +5,108 @@ import os
 import datetime
 
 import peewee
-import sqlite3
-from playhouse.migrate import *
+from playhouse.migrate import SqliteMigrator
+from playhouse.migrate import migrate
 
-
-logging.basicConfig(format='[%(asctime)s][%(name)s] %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
-parser = argparse.ArgumentParser()
 
 
-def main(db_filename):
-	db = peewee.SqliteDatabase(db_filepath, pragmas={'journal_mode': 'wal'})
+# Every migration brings an existing db from the previous version to its version. The db version is stored in
+# PRAGMA user_version: a migration runs only once, in a transaction together with the version update, so a failed
+# migration leaves the db untouched. Migrations must not import the models: they describe the schema at that
+# version, not the current one. New tables don't need a migration, create_tables() creates them
+
+
+def add_releases_columns(db, migrator):
+    # columns added to Releases when the assets job was introduced
+    columns = set(column.name for column in db.get_columns('Releases'))
+    new_columns = (
+        ('added_on', peewee.DateTimeField(default=datetime.datetime.now, null=True)),
+        ('post_id', peewee.IntegerField(null=True)),
+        ('checked', peewee.BooleanField(default=False, null=True)),
+        ('sent', peewee.BooleanField(default=False, null=True)),
+    )
+
+    migrate(*[migrator.add_column('Releases', name, field) for name, field in new_columns if name not in columns])
+
+
+def add_releases_index(db, _):
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "release_repository_added_on" ON "Releases" ("repository", "added_on")')
+
+
+def add_commits_added_on(db, migrator):
+    migrate(migrator.add_column('Commits', 'added_on', peewee.DateTimeField(null=True)))
+
+    # we don't know when the existing commits have been saved: they are pruned once the retention period
+    # has passed since this migration
+    db.execute_sql('UPDATE "Commits" SET "added_on" = ?', (str(datetime.datetime.now()),))
+
+
+# (version, table the migration changes, migration)
+MIGRATIONS = (
+    (1, 'Releases', add_releases_columns),
+    (2, 'Releases', add_releases_index),
+    (3, 'Commits', add_commits_added_on),
+)
 
-	migrator = SqliteMigrator(db)
+LATEST_VERSION = MIGRATIONS[-1][0]
 
-	added_on = peewee.DateTimeField(default=datetime.datetime.now, null=True)
-	post_id = peewee.IntegerField(null=True)
-	checked = peewee.BooleanField(default=False, null=True)
-	sent = peewee.BooleanField(default=False, null=True)
 
-	logger.info('Starting migration....')
+def get_version(db):
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
 
-	try:
-		migrate(
-			migrator.add_column('Releases', 'added_on', added_on),
-			migrator.add_column('Releases', 'post_id', post_id),
-			migrator.add_column('Releases', 'checked', checked),
-			migrator.add_column('Releases', 'sent', sent),
-		)
-	except (peewee.DatabaseError, sqlite3.DatabaseError):
-		print('database file {} is encrypted or is not a database'.format(db_filepath))
-		sys.exit(1)
 
-	logger.info('...migration completed')
+def set_version(db, version):
+    db.execute_sql('PRAGMA user_version = {:d}'.format(version))
+
+
+def run_migrations(db):
+    """Apply the migrations the db is missing. Must run before the tables are created: a new db (no tables yet)
+    is created with the current schema, so it starts at the latest version"""
+
+    version = get_version(db)
+    tables = set(db.get_tables())
+    if not tables:
+        logger.info('new database: schema version %d', LATEST_VERSION)
+        set_version(db, LATEST_VERSION)
+        return
+
+    migrator = SqliteMigrator(db)
+    for migration_version, table, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        logger.info('migrating the database to version %d (%s)...', migration_version, migration.__name__)
+        with db.atomic('IMMEDIATE'):
+            if table in tables:
+                migration(db, migrator)
+            set_version(db, migration_version)
+
+
+def main(db_filepath):
+    db = peewee.SqliteDatabase(db_filepath, pragmas={'journal_mode': 'wal'})
+
+    with db:
+        logger.info('database version: %d (latest: %d)', get_version(db), LATEST_VERSION)
+        run_migrations(db)
+
+    logger.info('...migration completed')
 
 
 if __name__ == '__main__':
-	parser.add_argument("-db", "--database", action="store", help="Database file path")
+    logging.basicConfig(format='[%(asctime)s][%(name)s] %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-db", "--database", action="store", help="Database file path")
 
-	args = parser.parse_args()
-	if not args.database:
-		print('pass a db filename using the -db [file path] argument')
-		sys.exit(1)
+    args = parser.parse_args()
+    if not args.database:
+        print('pass a db filename using the -db [file path] argument')
+        sys.exit(1)
 
-	db_filepath = os.path.normpath(args.database)
-	if not os.path.isfile(db_filepath):
-		print('{} does not exist or is a directory'.format(db_filepath))
-		sys.exit(1)
+    db_path = os.path.normpath(args.database)
+    if not os.path.isfile(db_path):
+        print('{} does not exist or is a directory'.format(db_path))
+        sys.exit(1)
 
-	main(db_filepath)
+    main(db_path)
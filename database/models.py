@@ -7,19 +7,103 @@ from config import config
 
 logger = logging.getLogger(__name__)
 
-db = peewee.SqliteDatabase(config.database.filename, pragmas={'journal_mode': 'wal'})
+# peewee keeps one connection per thread (the jobs, the pool workers, the outbox workers and the webhooks all
+# write concurrently), and applies the pragmas every time a connection is opened
+PRAGMAS = {
+    'journal_mode': 'wal',  # readers don't block the writer and vice versa
+    'synchronous': config.database.get('synchronous', 'normal'),  # with wal, "normal" is safe from corruption
+    'cache_size': -1024 * config.database.get('cache_size_mb', 16),  # negative: KiB instead of pages
+    'mmap_size': 1024 * 1024 * config.database.get('mmap_size_mb', 64),
+    'busy_timeout': config.database.get('busy_timeout', 10000),  # milliseconds to wait for the write lock
+}
+
+db = peewee.SqliteDatabase(config.database.filename, pragmas=PRAGMAS, timeout=PRAGMAS['busy_timeout'] / 1000)
+
+# keep IN (...) queries below the sqlite variables limit (999 on older versions)
+MAX_VARIABLES = 500
+
+
+def write_transaction():
+    """A transaction that takes the write lock as soon as it starts. A deferred transaction that reads and then
+    writes can't wait for the lock held by another connection (it would deadlock), so it fails immediately with
+    "database is locked": this one waits up to busy_timeout instead. Nested, it's a savepoint of the outer one"""
+
+    return db.atomic('IMMEDIATE')
+
+
+def chunks(items, size=MAX_VARIABLES):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# store the commits shas as 20 bytes blobs instead of 40 chars strings: the Commits table and its indexes are
+# about half the size
+BINARY_SHAS = config.database.get('binary_shas', False)
+
+
+class ShaField(peewee.CharField):
+    # the value is always a hex string, the format in the db depends on BINARY_SHAS
+    def db_value(self, value):
+        if value is not None and BINARY_SHAS:
+            return bytes.fromhex(value)
+
+        return value
+
+    def python_value(self, value):
+        return value.hex() if isinstance(value, bytes) else value
 
 
 class Commit(peewee.Model):
     repository = peewee.CharField()
     # branch = peewee.CharField(null=True)  # no need for this: commits are fetched globally for the repo, so they have the same sha and we don't need to check the repo name
-    sha = peewee.CharField(index=True)
+    sha = ShaField(index=True)
+    added_on = peewee.DateTimeField(default=datetime.datetime.now, null=True)  # used to prune the old commits
 
     class Meta:
         table_name = 'Commits'
         primary_key = peewee.CompositeKey('repository', 'sha')
         database = db
 
+    @classmethod
+    def filter_new(cls, repository, shas):
+        """Return the shas that are not saved yet, in the same order, with one query every MAX_VARIABLES shas"""
+
+        saved = set()
+        for chunk in chunks(list(shas)):
+            query = cls.select(cls.sha).where(cls.repository == repository, cls.sha.in_(chunk))
+            saved.update(commit.sha for commit in query)
+
+        return [sha for sha in shas if sha not in saved]
+
+    @classmethod
+    def add_many(cls, repository, shas):
+        rows = [dict(repository=repository, sha=sha) for sha in shas]
+        with write_transaction():
+            for chunk in chunks(rows, MAX_VARIABLES // 3):
+                cls.insert_many(chunk).on_conflict_ignore().execute()
+
+    @classmethod
+    def convert_shas(cls):
+        """Convert the shas saved in the other format to the one set by database.binary_shas. Returns how many
+        shas have been converted"""
+
+        other_type = 'text' if BINARY_SHAS else 'blob'
+        converted = 0
+        while True:
+            with write_transaction():
+                rows = list(
+                    cls.select(peewee.SQL('rowid'), cls.sha)
+                    .where(peewee.fn.typeof(cls.sha) == other_type)
+                    .limit(MAX_VARIABLES * 10)
+                    .tuples()
+                )
+                for rowid, sha in rows:
+                    cls.update(sha=sha).where(peewee.SQL('rowid = ?', [rowid])).execute()
+
+            converted += len(rows)
+            if not rows:
+                return converted
+
 
 class Release(peewee.Model):
     repository = peewee.CharField()
@@ -33,6 +117,165 @@ class Release(peewee.Model):
         table_name = 'Releases'
         primary_key = peewee.CompositeKey('repository', 'release_id')
         database = db
+        indexes = (
+            (('repository', 'added_on'), False),  # latest releases of a repo (assets job, polling schedule)
+        )
+
+    @classmethod
+    def filter_new(cls, releases):
+        """releases: list of (repository, release_id) tuples. Return the ones that are not saved yet, in the same order"""
+
+        saved = set()
+        for chunk in chunks(list(releases), MAX_VARIABLES // 2):
+            query = cls.select(cls.repository, cls.release_id).where(peewee.Tuple(cls.repository, cls.release_id).in_(chunk))
+            saved.update((release.repository, release.release_id) for release in query)
+
+        return [release for release in releases if release not in saved]
+
+    @classmethod
+    def add_many(cls, releases):
+        rows = [dict(repository=repository, release_id=release_id) for repository, release_id in releases]
+        with write_transaction():
+            for chunk in chunks(rows, MAX_VARIABLES // 2):
+                cls.insert_many(chunk).on_conflict_ignore().execute()
+
+    @classmethod
+    def latest_to_check(cls, assets_timedeltas):
+        """The most recent release of every repository in assets_timedeltas (a dict repository -> seconds), if its
+        assets have not been checked yet and it has been saved for at least that many seconds, with a single query.
+        Returns a dict repository -> Release"""
+
+        if not assets_timedeltas:
+            return {}
+
+        ranked = (
+            cls.select(cls, peewee.fn.ROW_NUMBER().over(
+                partition_by=[cls.repository],
+                order_by=[cls.added_on.desc()]
+            ).alias('position'))
+            .where(cls.added_on.is_null(False))
+            .alias('ranked')
+        )
+
+        # saved before this date, according to the repository. Other repositories get NULL, which excludes them
+        now = datetime.datetime.now()
+        added_before = peewee.Case(ranked.c.repository, [
+            (repository, str(now - datetime.timedelta(seconds=seconds)))
+            for repository, seconds in assets_timedeltas.items()
+        ])
+
+        query = (
+            cls.select(ranked.c.repository, ranked.c.release_id, ranked.c.post_id, ranked.c.added_on,
+                       ranked.c.checked, ranked.c.sent)
+            .from_(ranked)
+            .where(
+                ranked.c.position == 1,
+                (ranked.c.checked == False) | ranked.c.checked.is_null(),
+                ranked.c.added_on <= added_before
+            )
+        )
+
+        return {release.repository: release for release in query}
+
+    @classmethod
+    def last_added(cls):
+        """Returns a dict repository -> when its most recent release has been saved"""
+
+        query = cls.select(cls.repository, peewee.fn.MAX(cls.added_on)).group_by(cls.repository).tuples()
+        return {repository: added_on for repository, added_on in query if added_on}
+
+
+class BranchHead(peewee.Model):
+    # last head sha of a branch we processed, so the next run can ask only what changed since then
+    repository = peewee.CharField()
+    branch = peewee.CharField()
+    sha = peewee.CharField()
+    updated_on = peewee.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'BranchHeads'
+        primary_key = peewee.CompositeKey('repository', 'branch')
+        database = db
+
+    @classmethod
+    def last_updated(cls):
+        """Returns a dict repository -> when a branch of the repo moved for the last time"""
+
+        query = cls.select(cls.repository, peewee.fn.MAX(cls.updated_on)).group_by(cls.repository).tuples()
+        return {repository: updated_on for repository, updated_on in query if updated_on}
+
+
+class HttpValidator(peewee.Model):
+    # ETag/Last-Modified of the GitHub responses, so the next request can be a conditional one
+    url = peewee.CharField(primary_key=True)
+    etag = peewee.CharField(null=True)
+    last_modified = peewee.CharField(null=True)
+    updated_on = peewee.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'HttpValidators'
+        database = db
+
+
+class OutboxStatus:
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+
+class OutboxMessage(peewee.Model):
+    # messages rendered by the jobs, waiting to be delivered by the outbox worker
+    key = peewee.CharField(unique=True)  # the same message can't be enqueued twice
+    service = peewee.CharField()  # telegram or matrix
+    chat_id = peewee.CharField()  # Telegram chat id or Matrix room id
+    text = peewee.TextField()
+    repository = peewee.CharField(null=True)
+    release_id = peewee.IntegerField(null=True)  # the release whose post_id has to be saved once sent
+    status = peewee.CharField(default=OutboxStatus.PENDING, index=True)
+    attempts = peewee.IntegerField(default=0)
+    next_attempt_on = peewee.DateTimeField(default=datetime.datetime.now)
+    message_id = peewee.CharField(null=True)  # id of the sent message/event
+    added_on = peewee.DateTimeField(default=datetime.datetime.now)
+    sent_on = peewee.DateTimeField(null=True)
+
+    class Meta:
+        table_name = 'Outbox'
+        database = db
+
+    @classmethod
+    def add_many(cls, rows):
+        with write_transaction():
+            for chunk in chunks(rows, MAX_VARIABLES // 10):
+                cls.insert_many(chunk).on_conflict_ignore().execute()
+
+    @classmethod
+    def count_by_destination(cls, statuses):
+        """Returns a dict (service, chat_id) -> {status: count}"""
+
+        query = (
+            cls.select(cls.service, cls.chat_id, cls.status, peewee.fn.COUNT(cls.id).alias('count'))
+            .where(cls.status.in_(statuses))
+            .group_by(cls.service, cls.chat_id, cls.status)
+        )
+
+        counts = {}
+        for row in query:
+            counts.setdefault((row.service, row.chat_id), {})[row.status] = row.count
+
+        return counts
+
+    @classmethod
+    def oldest_pending(cls, service):
+        """The oldest pending message of every chat of the service: the messages of a chat are sent in order, so
+        they are the only ones that can be sent. A long queue of a chat doesn't hide the other chats"""
+
+        oldest = (
+            cls.select(peewee.fn.MIN(cls.id))
+            .where(cls.status == OutboxStatus.PENDING, cls.service == service)
+            .group_by(cls.chat_id)
+        )
+
+        return list(cls.select().where(cls.id.in_(oldest)).order_by(cls.id))
 
 
 class ReleaseToSend(peewee.Model):
@@ -48,11 +291,53 @@ class ReleaseToSend(peewee.Model):
 
 
 class Asset(peewee.Model):
-    release = peewee.ForeignKeyField(Release)
+    # release assets uploaded to Telegram, so the same file can be sent again by file_id without transferring it
+    asset_id = peewee.IntegerField(primary_key=True)  # GitHub asset id
+    size = peewee.IntegerField()
+    updated_at = peewee.CharField()  # GitHub asset updated_at: when it changes, the file has been replaced
+    md5 = peewee.CharField()
+    sha1 = peewee.CharField(index=True)
+    file_id = peewee.CharField(null=True)  # Telegram file_id of the uploaded document
     added_on = peewee.DateTimeField(default=datetime.datetime.now)
-    checked = peewee.BooleanField(default=False)
-    sent = peewee.BooleanField(default=False)
 
     class Meta:
         table_name = 'Assets'
         database = db
+
+    @classmethod
+    def get_uploaded(cls, gh_asset):
+        """The cached upload of a GitHub asset, if the asset didn't change since then"""
+
+        return cls.get_or_none(
+            cls.asset_id == gh_asset.id,
+            cls.size == gh_asset.size,
+            cls.updated_at == str(gh_asset.updated_at),
+            cls.file_id.is_null(False)
+        )
+
+    @classmethod
+    def get_uploaded_content(cls, sha1, size):
+        """Any uploaded asset with the same content (e.g. the same file attached to another release)"""
+
+        return (
+            cls.select()
+            .where(cls.sha1 == sha1, cls.size == size, cls.file_id.is_null(False))
+            .order_by(cls.added_on.desc())
+            .first()
+        )
+
+    @classmethod
+    def save_upload(cls, gh_asset, md5, sha1, file_id):
+        cls.replace(
+            asset_id=gh_asset.id,
+            size=gh_asset.size,
+            updated_at=str(gh_asset.updated_at),
+            md5=md5,
+            sha1=sha1,
+            file_id=file_id
+        ).execute()
+
+    @classmethod
+    def forget_file_id(cls, file_id):
+        # Telegram doesn't accept it anymore
+        cls.update(file_id=None).where(cls.file_id == file_id).execute()
@@ -0,0 +1,92 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import peewee
+
+from config import config
+from .models import Commit
+
+logger = logging.getLogger(__name__)
+
+# shas of a repo loaded from the db the first time the repo is checked: the jobs mostly ask about the last ones
+LOAD_SHAS = 1000
+
+
+class SeenIndex:
+    """In-process index of the commits already saved in the db, in front of the Commits table.
+
+    All the repos share a single LRU of max_shas entries, so the memory used doesn't grow with the number of repos:
+    every entry is the 20 bytes binary digest of the sha prefixed by the number of its repo (about 160 bytes with
+    the dict overhead). The index only holds shas that are in the db, so a hit never needs a query, and only the
+    misses are checked against the table"""
+
+    def __init__(self, max_shas):
+        self._max_shas = max_shas
+        self._keys = OrderedDict()  # least recently used first
+        self._prefixes = {}  # repository -> key prefix
+        self._lock = threading.Lock()
+
+    def _prefix(self, repository):
+        # lazily load the most recently saved shas of the repo
+        if repository not in self._prefixes:
+            self._prefixes[repository] = len(self._prefixes).to_bytes(4, 'big')
+
+            query = (
+                Commit.select(Commit.sha)
+                .where(Commit.repository == repository)
+                .order_by(peewee.SQL('rowid').desc())
+                .limit(min(LOAD_SHAS, self._max_shas))
+            )
+            shas = [commit.sha for commit in reversed(list(query))]
+            logger.info('loaded %d shas of %s in the index', len(shas), repository)
+            self._add(repository, shas)
+
+        return self._prefixes[repository]
+
+    def _add(self, repository, shas):
+        prefix = self._prefixes[repository]
+        for sha in shas:
+            key = prefix + bytes.fromhex(sha)
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+
+        while len(self._keys) > self._max_shas:
+            self._keys.popitem(last=False)
+
+    def filter_new(self, repository, shas):
+        """Same as Commit.filter_new(), but the db is queried only for the shas that are not in the index"""
+
+        misses = []
+        with self._lock:
+            prefix = self._prefix(repository)
+            for sha in shas:
+                key = prefix + bytes.fromhex(sha)
+                if key in self._keys:
+                    self._keys.move_to_end(key)
+                else:
+                    misses.append(sha)
+
+        if not misses:
+            return []
+
+        new_shas = Commit.filter_new(repository, misses)
+        logger.debug('%s: %d shas, %d not in the index, %d new', repository, len(shas), len(misses), len(new_shas))
+
+        with self._lock:
+            # shas that were in the db but had been evicted from (or never loaded in) the index
+            new_set = set(new_shas)
+            self._add(repository, [sha for sha in misses if sha not in new_set])
+
+        return new_shas
+
+    def mark_saved(self, repository, shas):
+        """Add to the index the shas saved with Commit.add_many(). Call it only once the transaction has been
+        committed: if it's rolled back, the shas must still be new for the next run"""
+
+        with self._lock:
+            self._prefix(repository)
+            self._add(repository, shas)
+
+
+seen_commits = SeenIndex(config.database.get('seen_index_size', 100000))
@@ -0,0 +1,8 @@
+from .client import GithubClient
+from .client import CachedResponse
+from .graphql import RepoSnapshot
+from .graphql import REPOS_BATCH
+from .graphql import fetch_repos
+from .ratelimit import rate_limiter
+from .ratelimit import Priority
+from .ratelimit import RateLimited
@@ -0,0 +1,220 @@
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+import requests
+from github.GithubException import GithubException
+from github.GithubException import UnknownObjectException
+
+import connections
+from config import config
+from database import HttpValidator
+from .ratelimit import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://api.github.com'
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# attempts of a request that hits a secondary rate limit
+MAX_ATTEMPTS = 3
+
+# how many commits to ask in a single GraphQL query
+COMMITS_STATS_BATCH = 50
+
+COMMIT_STATS_FRAGMENT = """c{index}: object(oid: "{sha}") {{ ... on Commit {{ oid additions deletions changedFilesIfAvailable }} }}"""
+
+
+class CachedResponse:
+    def __init__(self, key, response: requests.Response):
+        self.key = key
+        self.headers = response.headers
+        self.not_modified = response.status_code == 304
+        self.data = None if self.not_modified else response.json()
+        self.next_url = response.links.get('next', {}).get('url', None)
+        self.pages = 1
+        # paginated responses are not cached by default: the first page could be unchanged while the others are not
+        self.cacheable = not self.next_url
+
+    def store_validators(self):
+        """Save the validators of this response: call it only once the response has been fully processed,
+        otherwise a failed run would be skipped the next time because of the 304"""
+
+        if self.not_modified or not self.cacheable:
+            return
+
+        etag = self.headers.get('ETag', None)
+        last_modified = self.headers.get('Last-Modified', None)
+        if not etag and not last_modified:
+            return
+
+        HttpValidator.replace(url=self.key, etag=etag, last_modified=last_modified).execute()
+
+
+class RequestStats:
+    def __init__(self):
+        self.requests = 0
+        self.pages = 0
+        self.not_modified = 0
+
+    def __str__(self):
+        return '{} requests, {} pages, {} not modified'.format(self.requests, self.pages, self.not_modified)
+
+
+class GithubClient:
+    """Minimal REST client used for the requests that are repeated every cycle. Unlike PyGithub, it sends
+    conditional requests: a 304 Not Modified doesn't count against the rate limit.
+    Every request is scheduled by the rate limiter"""
+
+    def __init__(self):
+        self._session = connections.new_session()
+        self._session.headers['Accept'] = 'application/vnd.github+json'
+
+        if config.github.access_token:
+            self._session.headers['Authorization'] = 'token {}'.format(config.github.access_token)
+        else:
+            self._session.auth = (config.github.user, config.github.password)
+
+        # requests made by the current thread, see track()
+        self._local = threading.local()
+
+    @contextmanager
+    def track(self):
+        """Count the requests made by the current thread inside the block"""
+
+        stats = RequestStats()
+        self._local.stats = stats
+        try:
+            yield stats
+        finally:
+            self._local.stats = None
+
+    def _request(self, url, params=None, headers=None, method='GET', json=None):
+        stats = getattr(self._local, 'stats', None)
+        resource = 'graphql' if url == GRAPHQL_URL else 'core'
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            rate_limiter.acquire(resource)
+
+            if stats:
+                stats.requests += 1
+
+            response = self._session.request(method, url, params=params, headers=headers, json=json)
+
+            wait = rate_limiter.update(response)
+            if wait is None or attempt == MAX_ATTEMPTS:
+                break
+
+            logger.info('rate limited while requesting %s (attempt %d)', url, attempt)
+            # acquire() waits for the backoff, or raises RateLimited if it's too long
+
+        self._check(response)
+
+        if stats and response.status_code == 304:
+            stats.not_modified += 1
+
+        return response
+
+    @staticmethod
+    def _check(response: requests.Response):
+        if response.status_code < 400:
+            return
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = response.text
+
+        if response.status_code == 404:
+            raise UnknownObjectException(response.status_code, data, dict(response.headers))
+
+        raise GithubException(response.status_code, data, dict(response.headers))
+
+    def get(self, path, params=None):
+        url = path if path.startswith('http') else API_URL + path
+        return self._request(url, params=params).json()
+
+    def get_conditional(self, path, params=None) -> CachedResponse:
+        url = path if path.startswith('http') else API_URL + path
+        key = '{}?{}'.format(url, urlencode(sorted(params.items()))) if params else url
+
+        headers = {}
+        validator = HttpValidator.get_or_none(HttpValidator.url == key)
+        if validator:
+            if validator.etag:
+                headers['If-None-Match'] = validator.etag
+            if validator.last_modified:
+                headers['If-Modified-Since'] = validator.last_modified
+
+        response = self._request(url, params=params, headers=headers)
+
+        if response.status_code == 304:
+            logger.info('not modified: %s', key)
+
+        return CachedResponse(key, response)
+
+    def get_list(self, path, params=None, max_pages=1, cache_first_page=False) -> CachedResponse:
+        """Conditional request for the first page of a list. If it changed, up to max_pages pages are fetched
+        and response.data will contain the items of all of them.
+
+        Pass cache_first_page=True when an unchanged first page implies the next ones are unchanged too
+        (e.g. the commits of a given sha), or when only the first page is needed"""
+
+        response = self.get_conditional(path, params=params)
+        response.cacheable = response.cacheable or cache_first_page
+        if response.not_modified:
+            return response
+
+        next_url = response.next_url
+        while next_url and response.pages < max_pages:
+            page = self._request(next_url)
+            response.data.extend(page.json())
+            response.pages += 1
+            next_url = page.links.get('next', {}).get('url', None)
+
+        if next_url:
+            logger.info('%s: stopped after %d pages', response.key, response.pages)
+
+        stats = getattr(self._local, 'stats', None)
+        if stats:
+            stats.pages += response.pages
+
+        return response
+
+    def graphql(self, query, variables=None, partial=False):
+        """With partial=True errors are only logged, and the data that could be resolved is returned
+        (e.g. when one of the repositories in the query doesn't exist)"""
+
+        response = self._request(GRAPHQL_URL, method='POST', json=dict(query=query, variables=variables or {}))
+        result = response.json()
+        if result.get('errors', None):
+            if not partial or not result.get('data', None):
+                raise GithubException(response.status_code, result['errors'], dict(response.headers))
+
+            for error in result['errors']:
+                logger.warning('GraphQL error: %s', error.get('message', error))
+
+        return result['data']
+
+    def get_commits_stats(self, repo_path, shas):
+        """Files count, additions and deletions of many commits with one GraphQL query every COMMITS_STATS_BATCH
+        commits, instead of one REST request each. Returns a dict sha -> (files, additions, deletions).
+        Shas whose stats are not available are not in the dict"""
+
+        owner, name = repo_path.split('/')
+        stats = {}
+        for i in range(0, len(shas), COMMITS_STATS_BATCH):
+            fragments = [COMMIT_STATS_FRAGMENT.format(index=j, sha=sha) for j, sha in enumerate(shas[i:i + COMMITS_STATS_BATCH])]
+            query = 'query($owner: String!, $name: String!) {{ repository(owner: $owner, name: $name) {{ {} }} }}'.format(
+                ' '.join(fragments)
+            )
+            data = self.graphql(query, variables=dict(owner=owner, name=name))
+
+            for commit in data['repository'].values():
+                if not commit or commit['changedFilesIfAvailable'] is None:
+                    continue
+
+                stats[commit['oid']] = (commit['changedFilesIfAvailable'], commit['additions'], commit['deletions'])
+
+        return stats
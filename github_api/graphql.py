@@ -0,0 +1,125 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# how many repositories to ask in a single query
+REPOS_BATCH = 50
+
+RELEASES_FRAGMENT = """releases(first: 3, orderBy: {field: CREATED_AT, direction: DESC}) {
+      nodes {
+        databaseId tagName name url description isPrerelease isDraft createdAt publishedAt
+      }
+    }"""
+
+# only what's needed to tell whether there's a new release
+RELEASE_IDS_FRAGMENT = """releaseIds: releases(first: 3, orderBy: {field: CREATED_AT, direction: DESC}) {
+      nodes { databaseId createdAt }
+    }"""
+
+BRANCHES_FRAGMENT = """refs(refPrefix: "refs/heads/", first: 100, orderBy: {field: ALPHABETICAL, direction: ASC}) {
+      pageInfo { hasNextPage }
+      nodes { name target { oid } }
+    }"""
+
+REPO_FRAGMENT = """r{index}: repository(owner: {owner}, name: {name}) {{
+    nameWithOwner
+    {fragments}
+  }}"""
+
+
+class RepoSnapshot:
+    """Releases and branches of a repo fetched through the GraphQL API, as REST-like payloads"""
+
+    def __init__(self, path, releases=None, branches=None, newest_release_id=None):
+        self.path = path
+        self.releases = releases
+        self.branches = branches
+        self.newest_release_id = newest_release_id
+
+
+def build_repos_query(paths, releases=True, branches=True, release_ids=False):
+    fragments = []
+    if releases:
+        fragments.append(RELEASES_FRAGMENT)
+    if release_ids:
+        fragments.append(RELEASE_IDS_FRAGMENT)
+    if branches:
+        fragments.append(BRANCHES_FRAGMENT)
+
+    repos_fragments = []
+    for index, path in enumerate(paths):
+        owner, name = path.split('/')
+        repos_fragments.append(REPO_FRAGMENT.format(
+            index=index,
+            owner=json.dumps(owner),
+            name=json.dumps(name),
+            fragments='\n    '.join(fragments)
+        ))
+
+    return 'query {{\n  {}\n}}'.format('\n  '.join(repos_fragments))
+
+
+def rest_release(node):
+    """Convert a GraphQL release node to the shape of the REST payload, so it can be used to build a GitRelease"""
+
+    return dict(
+        id=node['databaseId'],
+        tag_name=node['tagName'],
+        name=node['name'],
+        html_url=node['url'],
+        body=node['description'],
+        prerelease=node['isPrerelease'],
+        draft=node['isDraft'],
+        created_at=node['createdAt'],
+        published_at=node['publishedAt'],
+        # not needed by the release message: the assets job gets the release (and its assets) through REST
+        assets=[]
+    )
+
+
+def rest_branch(node):
+    return dict(name=node['name'], commit=dict(sha=node['target']['oid']))
+
+
+def newest_release_id(nodes):
+    # same as the releases job: the most recent by creation date among the first three
+    if not nodes:
+        return None
+
+    return max(nodes, key=lambda node: node['createdAt'])['databaseId']
+
+
+def parse_repos_response(paths, data):
+    """Returns a dict path -> RepoSnapshot. Repos that were not found, or that have too many branches for a
+    single query, are left out: the caller is expected to fall back to the REST API for them"""
+
+    snapshots = {}
+    for index, path in enumerate(paths):
+        repo = data.get('r{}'.format(index), None)
+        if not repo:
+            logger.warning('repo %s not found in the GraphQL response', path)
+            continue
+
+        if 'refs' in repo and repo['refs']['pageInfo']['hasNextPage']:
+            logger.info('repo %s has more than 100 branches, it will be polled through the REST API', path)
+            continue
+
+        snapshots[path] = RepoSnapshot(
+            path,
+            releases=[rest_release(node) for node in repo['releases']['nodes']] if 'releases' in repo else None,
+            branches=[rest_branch(node) for node in repo['refs']['nodes']] if 'refs' in repo else None,
+            newest_release_id=newest_release_id(repo['releaseIds']['nodes']) if 'releaseIds' in repo else None
+        )
+
+    return snapshots
+
+
+def fetch_repos(client, paths, releases=True, branches=True, release_ids=False):
+    """Fetch the latest releases (or just the id of the newest one) and/or the branches heads of up to
+    REPOS_BATCH repos with a single query"""
+
+    query = build_repos_query(paths, releases=releases, branches=branches, release_ids=release_ids)
+    data = client.graphql(query, partial=True)
+
+    return parse_repos_response(paths, data)
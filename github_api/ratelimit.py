@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class Priority:
+    HIGH = 0  # releases/assets: allowed to use the whole budget
+    LOW = 1  # commits: stop when only the reserve is left
+
+
+class RateLimited(Exception):
+    def __init__(self, resource, wait):
+        self.resource = resource
+        self.wait = wait
+        super(RateLimited, self).__init__('GitHub {} rate limit: {} seconds to wait'.format(resource, int(wait)))
+
+
+class JobBudget:
+    def __init__(self, name, priority):
+        self.name = name
+        self.priority = priority
+        self.used = 0  # requests that counted against the rate limit (304s don't)
+        self.waited = 0.0
+
+
+class ResourceState:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+        self.next_slot = 0.0
+
+
+# the job the current task belongs to. The poller copies the context to the pool threads
+current_job: ContextVar = ContextVar('current_job', default=None)
+
+
+class RateLimiter:
+    """Schedules the requests of all the jobs against the GitHub rate limit.
+
+    - the remaining budget is tracked from the X-RateLimit-* headers, separately for each resource (core, graphql)
+    - low priority requests stop when only the reserve is left, so releases can still be checked
+    - below the pacing threshold, requests are spread until the reset instead of burning the budget at once
+    - secondary rate limits (403/429, Retry-After) block every request until the backoff expires
+
+    Waits longer than max_wait raise RateLimited instead of sleeping, so the task is skipped until the next run"""
+
+    def __init__(self, reserve, pacing_threshold, max_wait):
+        self._reserve = reserve
+        self._pacing_threshold = pacing_threshold
+        self._max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self._resources = {}
+        self._blocked_until = 0.0
+        self._secondary_backoff = 0
+        self._usage = Counter()
+
+    @contextmanager
+    def job(self, name, priority=Priority.HIGH):
+        budget = JobBudget(name, priority)
+        token = current_job.set(budget)
+        try:
+            yield budget
+        finally:
+            current_job.reset(token)
+            logger.info('%s used %d requests of the GitHub budget (%.1f seconds waiting), %s', name, budget.used,
+                        budget.waited, self.status())
+
+    def accounted(self, name, priority=Priority.HIGH):
+        """Decorator: the GitHub requests made by the function are accounted to the job name"""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapped(*args, **kwargs):
+                with self.job(name, priority):
+                    return func(*args, **kwargs)
+
+            return wrapped
+
+        return decorator
+
+    def _wait_time(self, resource, priority, now):
+        if self._blocked_until > now:
+            return self._blocked_until - now
+
+        state = self._resources.get(resource, None)
+        if not state or state.remaining is None or state.reset_at <= now:
+            # unknown budget or window already reset
+            return 0
+
+        available = state.remaining - (self._reserve if priority == Priority.LOW else 0)
+        if available <= 0:
+            return state.reset_at - now
+
+        wait = 0
+        if state.remaining < self._pacing_threshold:
+            # spread what's left until the reset
+            slot = max(now, state.next_slot)
+            state.next_slot = slot + (state.reset_at - now) / available
+            wait = slot - now
+
+        # optimistic: the next response will tell the real value
+        state.remaining -= 1
+
+        return wait
+
+    def acquire(self, resource='core'):
+        budget = current_job.get()
+        priority = budget.priority if budget else Priority.HIGH
+
+        with self._lock:
+            wait = self._wait_time(resource, priority, time.time())
+
+        if wait <= 0:
+            return
+
+        if wait > self._max_wait:
+            raise RateLimited(resource, wait)
+
+        logger.debug('waiting %.1f seconds for the %s rate limit', wait, resource)
+        if budget:
+            budget.waited += wait
+        time.sleep(wait)
+
+    def update(self, response):
+        """Read the rate limit headers of a response. Returns the seconds to wait before retrying
+        if the response is a rate limit error, otherwise None"""
+
+        headers = response.headers
+        resource = headers.get('X-RateLimit-Resource', 'core')
+        now = time.time()
+
+        with self._lock:
+            if 'X-RateLimit-Remaining' in headers:
+                state = self._resources.setdefault(resource, ResourceState())
+                state.limit = int(headers.get('X-RateLimit-Limit', 0))
+                state.remaining = int(headers['X-RateLimit-Remaining'])
+                state.reset_at = float(headers.get('X-RateLimit-Reset', now))
+
+            if response.status_code != 304:
+                budget = current_job.get()
+                if budget:
+                    budget.used += 1
+                    self._usage[budget.name] += 1
+
+            if response.status_code not in (403, 429):
+                self._secondary_backoff = 0
+                return
+
+            if headers.get('Retry-After', None):
+                wait = float(headers['Retry-After'])
+            elif headers.get('X-RateLimit-Remaining', None) == '0':
+                wait = float(headers.get('X-RateLimit-Reset', now)) - now
+            elif 'rate limit' in response.text.lower():
+                # secondary rate limit without Retry-After: exponential backoff starting from one minute
+                self._secondary_backoff = min(max(self._secondary_backoff * 2, 60), 900)
+                wait = self._secondary_backoff
+            else:
+                # just a forbidden request
+                return
+
+            self._blocked_until = max(self._blocked_until, now + wait)
+            logger.warning('GitHub rate limit hit (%d), blocking requests for %d seconds', response.status_code, wait)
+
+            return wait
+
+    def usage(self):
+        """Requests that counted against the rate limit, by job, since the bot started"""
+
+        with self._lock:
+            return dict(self._usage)
+
+    def status(self):
+        with self._lock:
+            return ', '.join('{}: {}/{} left, reset in {}s'.format(
+                resource,
+                state.remaining,
+                state.limit,
+                max(0, int(state.reset_at - time.time()))
+            ) for resource, state in self._resources.items()) or 'budget unknown'
+
+
+rate_limiter = RateLimiter(
+    reserve=config.jobs.github.get('rate_limit_reserve', 500),
+    pacing_threshold=config.jobs.github.get('rate_limit_pacing', 1000),
+    max_wait=config.jobs.github.get('rate_limit_max_wait', 30)
+)
@@ -1,33 +1,52 @@
 import os
 import logging
 import re
-import time
+from collections import OrderedDict
+from datetime import date
 from datetime import datetime
 from datetime import timedelta
-from html import escape
+from datetime import timezone
 from typing import List
 
 from lxml import html
 
 from bs4 import BeautifulSoup
-import requests
-from github import Github, Branch, Repository, Commit as GithubCommit
+from github import Github, Branch
+from github.GithubException import GithubException
 from github.GithubException import UnknownObjectException
 from github import GitRelease
 from telegram.error import BadRequest
 from telegram.error import TelegramError
 from telegram import Bot
 from telegram import ParseMode
-from telegram import MAX_MESSAGE_LENGTH
 
+import connections
 from config import config
 from config import repos
+from database import write_transaction
 from database import Commit
 from database import Release
-from database import DoesNotExist
+from database import BranchHead
+from database import seen_commits
+from database import maintenance
+from github_api import GithubClient
+from github_api import CachedResponse
+from github_api import RepoSnapshot
+from github_api import REPOS_BATCH
+from github_api import fetch_repos
+from github_api import rate_limiter
+from github_api import Priority
+from github_api import RateLimited
 from matrix import Matrix
 from matrix import FakeMatrix
 from sender import Sender
+import outbox
+import render
+from assets import send_assets
+from assets import release_executor
+import poller
+from schedule import repo_schedule
+from runner import repo_locks
 import utils as u
 
 logger = logging.getLogger(__name__)
@@ -39,6 +58,7 @@ else:
     logger.info('logging in to gitHub via user/password')
     g = Github(config.github.user, config.github.password)
 
+github_client = GithubClient()
 
 if config.matrix.enabled:
     matrix_client = Matrix()
@@ -46,26 +66,13 @@ else:
     matrix_client = FakeMatrix()
 
 
-NEW_RELEASE_STRING = """<a href="{release_url}">New {repo_name} release</a>: \
-<code>{release_tag}</code> ({channel})
-{release_body}
-
-#{hashtag}"""
-
-NEW_RELEASE_DOWNLOAD = """
-
-<b>Download</b>:
-{assets_download}"""
-
-ASSET_STRING = '• <a href="{asset_download}">{asset_label}</a>'
+# max number of branches pages (100 branches each) to fetch for a repo
+BRANCHES_MAX_PAGES = 10
 
 CAPTION = """<b>{asset_label}</b>
 <b>md5</b>: <code>{md5}</code>
 <b>sha1</b>: <code>{sha1}</code>"""
 
-NEW_COMMIT_STRING = """<a href="{branch_url}">{repo_name}</a> • <a href="{commit_url}">{commit_sha}</a> • <i>{n_files} files, +{commit_additions}/-{commit_deletions}</i>
-{commit_message}"""
-
 NEW_BETA_CAPTION = """🎉 <b>New Android Beta!</b>
 
 <b>Version</b>: <code>{app_version}</code> ({build_number})"""
@@ -74,199 +81,545 @@ NEW_BETA_HASHES = """<b>md5</b>: <code>{md5}</code>
 <b>sha1</b>: <code>{sha1}</code>"""
 
 
-def append_hashtag(text, hashtag):
-    if not hashtag:
-        return text
+def fetch_repos_batch(paths, releases, branches, release_ids):
+    with github_client.track() as stats:
+        snapshots = fetch_repos(github_client, paths, releases=releases, branches=branches, release_ids=release_ids)
+
+    logger.info('%d repos fetched through the GraphQL API with %s', len(snapshots), stats)
+
+    return snapshots
+
+
+def prefetch_repos(tasks, releases=False, branches=False, release_ids=False):
+    """With the graphql backend, fetch what the job needs for all the repos with a query every REPOS_BATCH repos.
+    Returns a dict repo path -> RepoSnapshot. Repos that are not in the dict go through the REST API"""
+
+    if config.jobs.github.get('backend', 'rest') != 'graphql':
+        return {}
+
+    if not config.github.access_token:
+        logger.warning('the GraphQL API needs an access token: falling back to the REST API')
+        return {}
+
+    paths = sorted(set(repo_data.path for _, repo_data in tasks))
+    batches = [(paths[i:i + REPOS_BATCH], releases, branches, release_ids) for i in range(0, len(paths), REPOS_BATCH)]
+
+    snapshots = {}
+    results, error, _ = poller.run_all(fetch_repos_batch, batches, skip=RateLimited)
+    for _, batch_snapshots in results:
+        snapshots.update(batch_snapshots)
+
+    if error:
+        logger.error('some GraphQL batches failed, their repos will be polled through the REST API: %s', str(error))
+
+    return snapshots
+
+
+def store_validators(response: [CachedResponse, None]):
+    # there's no response when the data comes from the GraphQL API or the compare endpoint
+    if response:
+        response.store_validators()
+
+
+def fetch_latest_release(repo_desc, repo_data, snapshot: [RepoSnapshot, None] = None):
+    """Runs on the pool: returns the releases response (None when using the GraphQL snapshot) and the most recent
+    release (None if the repo has no release), or None if there's nothing to do"""
+
+    repo_name = repo_data.path
+    logger.info('>>> loop: releases of %s', repo_desc)
+
+    if snapshot:
+        return None, latest_release(repo_name, snapshot.releases)
+
+    try:
+        with github_client.track() as stats:
+            # we only need the first three
+            response = github_client.get_list('/repos/{}/releases'.format(repo_name), params=dict(per_page=3),
+                                              cache_first_page=True)
+    except UnknownObjectException as e:
+        logger.error('error while getting repo %s: %s', repo_name, str(e))
+        return
+    except RateLimited:
+        # the poller skips the task, so the repo stays due
+        raise
+    except Exception as e:
+        error_string = str(e)
+        logger.error('error while fetching repo %s releases: %s (continuing loop...)', repo_name, error_string)
+        return
+
+    logger.info('releases of %s fetched with %s', repo_name, stats)
+
+    if response.not_modified:
+        logger.info('releases of %s did not change since the last check, continuing to the next one...', repo_name)
+        return
+
+    return response, latest_release(repo_name, response.data)
+
+
+def latest_release(repo_name, raw_releases):
+    if len(raw_releases) == 0:
+        logger.info('no releases for repo %s, continuing to the next one...', repo_name)
+        return
+
+    releases = [g.create_from_raw_data(GitRelease.GitRelease, raw_release) for raw_release in raw_releases]
+
+    # the GitHub API has this weird bug that the most recent release is not always the first one
+    # in the returned list, so we request the 3 most recent releases and find out which one to consider by ourself
+    release: GitRelease.GitRelease = None
+    for r in releases:
+        if not release or r.created_at > release.created_at:
+            # r.published_at can be used too
+            release = r
+
+    logger.info('most recent release of %s among the last three: %s', repo_name, release.tag_name)
+
+    return release
+
+
+def post_new_releases(repos_releases):
+    """Save and queue the messages of the releases that are not saved yet. repos_releases is a list of
+    (repo_data, GitRelease). Used by the releases job and by the webhooks"""
+
+    # check all the releases at once
+    new_releases = set(Release.filter_new([(repo_data.path, release.id) for repo_data, release in repos_releases]))
+    logger.info('%d new releases out of %d', len(new_releases), len(repos_releases))
+
+    messages = []
+    for repo_data, release in repos_releases:
+        repo_name = repo_data.path
+
+        if (repo_name, release.id) not in new_releases:
+            logger.info('release %s (%s) of %s is already saved in db, continuing to next repo...', release.id,
+                        release.tag_name, repo_name)
+            continue
+
+        logger.info('release %s (%s) of %s is new', release.id, release.tag_name, repo_name)
+
+        renderer = render.repo_renderer(repo_name, repo_data.hashtag)
+        messages.append((repo_data, release, renderer.messages([renderer.release(release)])))
 
-    return '{}\n\n#{}'.format(text.strip(), hashtag)
+    # the releases are saved together with their messages: the outbox worker will post them (and save the post_id
+    # of the first message, if a long release has been split)
+    logger.info('saving %d new releases in db...', len(new_releases))
+    with write_transaction():
+        Release.add_many(new_releases)
+        for repo_data, release, release_messages in messages:
+            key = 'release:{}:{}'.format(repo_data.path, release.id)
+            for _, part, text in release_messages:
+                if not part:
+                    outbox.enqueue(repo_data, text, key=key, release_id=release.id)
+                else:
+                    outbox.enqueue(repo_data, text, key='{}:{}'.format(key, part))
+
+    return len(messages)
+
+
+def detect_new_releases(tasks):
+    """With the graphql backend, ask only the id of the newest release of every repo (one small query every
+    REPOS_BATCH repos) and keep the repos whose newest release is not saved yet: only those need the full
+    releases payload. Repos the query couldn't resolve are kept, and go through the REST API"""
+
+    ids_snapshots = prefetch_repos(tasks, release_ids=True)
+    if not ids_snapshots:
+        return tasks
+
+    newest_releases = [(path, snapshot.newest_release_id) for path, snapshot in ids_snapshots.items()
+                       if snapshot.newest_release_id is not None]
+    changed_paths = set(path for path, _ in Release.filter_new(newest_releases))
+
+    changed_tasks = [(repo_desc, repo_data) for repo_desc, repo_data in tasks
+                     if repo_data.path not in ids_snapshots or repo_data.path in changed_paths]
+    logger.info('%d repos out of %d have a new release (or could not be checked)', len(changed_tasks), len(tasks))
+
+    return changed_tasks
 
 
 @u.logerrors
+@rate_limiter.accounted('releases_job', Priority.HIGH)
 def releases_job(bot, _):
     logger.info('running releases job at %s...', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     if config.jobs.github.disable_releases:
         logger.info('releases job is disabled, exiting job')
         return
 
-    sender = Sender(bot, matrix_client)
+    tasks = [(repo_desc, repo_data) for repo_desc, repo_data in repos.repos.items() if repo_data.releases and (repo_data.chat_ids or repo_data.room_ids)]
 
-    for repo_desc, repo_data in repos.repos.items():
-        if not repo_data.releases or not repo_data.chat_id:
-            continue
+    # quiet repos are checked less often, and repos being processed by a webhook are skipped
+    tasks = repo_schedule.due('releases_job', tasks)
+    checked = set()
+    try:
+        with repo_locks.hold_many('releases', tasks) as tasks:
+            poll_releases(tasks, checked)
+    finally:
+        # the repos that have been skipped or have failed stay due, so the next run tries them again
+        repo_schedule.mark_checked('releases_job', checked)
 
-        repo_name = repo_data.path
-        logger.info('>>> loop: releases of %s', repo_desc)
+    logger.info('job finished')
+
+
+def poll_releases(tasks, checked):
+    """The repos that have been polled are added to checked"""
+
+    repositories = [repo_data.path for _, repo_data in tasks]
+    tasks = detect_new_releases(tasks)
+    snapshots = prefetch_repos(tasks, releases=True)
+    tasks = [(repo_desc, repo_data, snapshots.get(repo_data.path, None)) for repo_desc, repo_data in tasks]
+
+    # GitHub requests run concurrently, db writes and posting happen here in the configured repos order
+    results, fetch_error, unfinished = poller.run_all(fetch_latest_release, tasks, skip=RateLimited)
+
+    post_new_releases([(repo_data, release) for (_, repo_data, _), (_, release) in results if release])
+
+    for _, (response, _) in results:
+        store_validators(response)
+
+    unfinished_repos = set(task[1].path for task in unfinished)
+    checked.update(repository for repository in repositories if repository not in unfinished_repos)
+
+    if fetch_error:
+        raise fetch_error
+
+
+def get_commits_stats(repo_name, shas):
+    """The commits list doesn't include files and stats: get them for all the new commits at once according to
+    jobs.github.commits_stats. Returns a dict sha -> (files, additions, deletions)"""
+
+    mode = config.jobs.github.get('commits_stats', 'graphql')
+    if not shas or mode == 'none':
+        return {}
+
+    if mode == 'graphql' and config.github.access_token:
+        # the GraphQL API can't be used with user/password
+        try:
+            return github_client.get_commits_stats(repo_name, shas)
+        except GithubException as e:
+            logger.error('error while getting commits stats of %s: %s (commits will be posted without stats)',
+                         repo_name, str(e))
+            return {}
 
+    # one request per commit
+    commits_stats = {}
+    for sha in shas:
+        commit = github_client.get('/repos/{}/commits/{}'.format(repo_name, sha))
+        commits_stats[sha] = (len(commit['files']), commit['stats']['additions'], commit['stats']['deletions'])
+
+    return commits_stats
+
+
+def is_tracked_branch(repo_data, branch_name):
+    if repo_data.branch and branch_name.lower() != repo_data.branch.lower():
+        logger.info("branch %s is not the tracked one, continuing...", branch_name)
+        return False
+
+    if repo_data.get('ignored_branches', None) and branch_name in repo_data.ignored_branches:
+        logger.info("branch %s is ignored, continuing...", branch_name)
+        return False
+
+    if branch_name.startswith("dependabot"):
+        logger.info("ignoring branch %s: dependabot branch", branch_name)
+        return False
+
+    return True
+
+
+def fetch_branches(repo_desc, repo_data, snapshot: [RepoSnapshot, None] = None):
+    """Runs on the pool: returns the branches response (None when using the GraphQL snapshot) and the list
+    of (branch, last processed head sha) to check, or None if there's nothing to do"""
+
+    repo_name = repo_data.path
+    logger.info('>>> loop: commits of %s', repo_desc)
+
+    if snapshot:
+        response, raw_branches = None, snapshot.branches
+    else:
         try:
-            repo = g.get_repo(repo_name)
+            with github_client.track() as stats:
+                response = github_client.get_list('/repos/{}/branches'.format(repo_name), params=dict(per_page=100),
+                                                  max_pages=BRANCHES_MAX_PAGES)
         except UnknownObjectException as e:
             logger.error('error while getting repo %s: %s', repo_name, str(e))
-            continue
+            return
 
-        try:
-            releases = repo.get_releases()
-        except Exception as e:
-            error_string = str(e)
-            logger.error('error while fetching repo %s releases: %s (continuing loop...)', repo_name, error_string)
-            continue
+        logger.info('branches of %s fetched with %s', repo_name, stats)
+
+        if response.not_modified:
+            logger.info('no branch of %s has been updated since the last check, continuing to the next one...', repo_name)
+            return
 
-        if len(list(releases)) == 0:
-            logger.info('no releases for this repo, continuing to the next one...')
+        raw_branches = response.data
+
+    branches: List[Branch.Branch] = [g.create_from_raw_data(Branch.Branch, raw_branch) for raw_branch in raw_branches]
+    branches_count = len(branches)
+    if branches_count == 1:
+        logger.info('repo %s has only one branch', repo_name)
+    else:
+        logger.info('repo %s has %d branches: %s', repo_name, branches_count, ', '.join([b.name for b in branches]))
+
+    tracked_branches = [branch for branch in branches if is_tracked_branch(repo_data, branch.name)]
+
+    # branches whose head didn't move since the last run don't need any other request
+    heads = {head.branch: head.sha for head in BranchHead.select().where(BranchHead.repository == repo_name)}
+    updated_branches = []
+    for branch in tracked_branches:
+        last_sha = heads.get(branch.name, None)
+        if last_sha == branch.commit.sha:
+            logger.info('branch %s/%s did not move since the last run (%s), continuing...', repo_name, branch.name,
+                        last_sha[:7])
             continue
 
-        if len(list(releases)) > 3:
-            # we only need the first three
-            releases = releases[:3]
+        updated_branches.append((branch, last_sha))
+
+    return response, updated_branches
+
+
+def fetch_branch_commits(repo_desc, repo_data, branch: Branch.Branch, last_sha, from_date):
+    """Runs on the pool: returns the commits list response (None if the compare endpoint was used) and
+    the commits of the branch, oldest first (None if the list didn't change since the last check)"""
+
+    repo_name = repo_data.path
+    logger.info('getting commits of %s/%s', repo_name, branch.name)
+
+    with github_client.track() as stats:
+        response, raw_commits = list_branch_commits(repo_name, branch, last_sha, from_date)
+
+    logger.info('commits of %s/%s fetched with %s', repo_name, branch.name, stats)
 
-        # the GitHub API has this weird bug that the most recent release is not always the first one
-        # in the returned list, so we request the 3 most recent releases and find out which one to consider by ourself
-        release: GitRelease = None
-        for r in releases:
-            if not release or r.created_at > release.created_at:
-                # r.published_at can be used too
-                release = r
+    return response, raw_commits
 
-        logger.info('most recent release among the last three: %s', release.tag_name)
 
+def list_branch_commits(repo_name, branch: Branch.Branch, last_sha, from_date):
+    """Returns the commits list response (None if the compare endpoint was used) and the commits, oldest first.
+    Commits are None if the list didn't change since the last check"""
+
+    if last_sha:
+        # only what has been pushed since the last run
         try:
-            Release.get(Release.repository == repo_name, Release.release_id == release.id)
-            logger.info('release %s (%s) is already saved in db, continuing to next repo...', release.id, release.tag_name)
+            comparison = github_client.get('/repos/{}/compare/{}...{}'.format(repo_name, last_sha, branch.commit.sha))
+        except UnknownObjectException:
+            # the old head doesn't exist anymore
+            comparison = None
+
+        if comparison and comparison['status'] in ('ahead', 'identical') and comparison['total_commits'] == len(comparison['commits']):
+            logger.info('%d commits pushed on %s/%s since %s', len(comparison['commits']), repo_name, branch.name, last_sha[:7])
+            return None, comparison['commits']
+
+        logger.info('%s/%s: force-push or too many new commits since %s, listing the commits of the last days',
+                    repo_name, branch.name, last_sha[:7])
+
+    # first run or force-push: we fall back to the time window
+    # the list of a given sha never changes, so if the first page is unchanged the others are unchanged too
+    params = dict(sha=branch.commit.sha, since=from_date.strftime('%Y-%m-%dT%H:%M:%SZ'), per_page=100)
+    response = github_client.get_list('/repos/{}/commits'.format(repo_name), params=params,
+                                      max_pages=config.jobs.github.get('commits_max_pages', 3), cache_first_page=True)
+    if response.not_modified:
+        return response, None
+
+    logger.info('fetched %d total commits of %s/%s since %s (%d days ago, %d pages)', len(response.data), repo_name,
+                branch.name, from_date.strftime("%Y-%m-%d %H:%M:%S"), config.jobs.github.commits_days_backwards,
+                response.pages)
+
+    # reverse commits order
+    return response, list(reversed(response.data))
+
+
+def commit_date(raw_commit):
+    """Committer date of a commit in UTC, or None if the payload doesn't have it"""
+
+    committer = raw_commit['commit'].get('committer', None)
+    if not committer or not committer.get('date', None):
+        return None
+
+    commit_datetime = datetime.fromisoformat(committer['date'].replace('Z', '+00:00'))
+    return commit_datetime.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class BranchCommits:
+    def __init__(self, branch: Branch.Branch, response):
+        self.branch = branch
+        self.response = response
+        # (sha, rendered text) of the new commits attributed to this branch, oldest first
+        self.new_commits = []
+
+
+def process_repo_commits(repo_desc, repo_data, branches_commits):
+    """Runs on the pool: dedup and render the commits of all the branches of a repo.
+
+    branches_commits is a list of (branch, response, raw commits). Branches share their history, so a
+    commit is checked and rendered only once per run, and attributed to the first branch (by name) that contains
+    it. Stats are requested once for all the new commits of the repo. Returns a list of BranchCommits"""
+
+    repo_name = repo_data.path
+
+    results = []
+    seen_this_run = set()
+    new_raw_commits = {}
+
+    for branch, response, raw_commits in sorted(branches_commits, key=lambda item: item[0].name):
+        result = BranchCommits(branch, response)
+        results.append(result)
+
+        if raw_commits is None:
+            logger.info('commits of %s/%s did not change since the last check', repo_name, branch.name)
             continue
-        except DoesNotExist:
-            logger.info('release %s (%s) is new, saving in db...', release.id, release.tag_name)
-            db_release = Release.create(repository=repo_name, release_id=release.id)
-            logger.info('...release record created, github release id: %d', db_release.release_id)
-
-        assets_urls_list = []
-        assets = release.get_assets()
-        logger.info('%d assets found', len(list(assets)))
-        for asset in assets:
-            assets_urls_list.append(ASSET_STRING.format(
-                asset_download=asset.browser_download_url,
-                asset_label=asset.label
-            ))
-
-        assets_list_text = '\n'.join(assets_urls_list)
-
-        text = NEW_RELEASE_STRING.format(
-            release_url=release.html_url,
-            release_tag=release.tag_name,
-            release_body='\n' + release.body if release.body else '',
-            repo_name=repo.full_name,
-            channel='beta' if release.prerelease else 'stable',
-            assets_download=assets_list_text,
-            hashtag=repo_data.hashtag
-        )
 
-        new_release_message, _ = sender.send_message(repo_data, text)
-        if new_release_message:
-            # do not write the release id on the file so the job will retry to send that the next time
+        # compare and push payloads are not limited to the commits window: they can include commits so old that they
+        # have been pruned (e.g. a merged feature branch), which would be posted again
+        horizon = maintenance.retention_horizon()
+        recent_commits = [raw_commit for raw_commit in raw_commits if (commit_date(raw_commit) or horizon) >= horizon]
+        if len(recent_commits) < len(raw_commits):
+            logger.info('%s/%s: ignoring %d commits older than the retention period', repo_name, branch.name,
+                        len(raw_commits) - len(recent_commits))
+            raw_commits = recent_commits
 
-            db_release.post_id = new_release_message.message_id
-            db_release.save()
+        shas = [raw_commit['sha'] for raw_commit in raw_commits if raw_commit['sha'] not in seen_this_run]
+        seen_this_run.update(raw_commit['sha'] for raw_commit in raw_commits)
 
-    logger.info('job finished')
+        new_shas = seen_commits.filter_new(repo_name, shas)
+        logger.info('%s/%s: %d commits, %d already checked for another branch, %d saved in db', repo_name, branch.name,
+                    len(raw_commits), len(raw_commits) - len(shas), len(shas) - len(new_shas))
+
+        raw_commits_by_sha = {raw_commit['sha']: raw_commit for raw_commit in raw_commits}
+        for sha in new_shas:
+            new_raw_commits[sha] = raw_commits_by_sha[sha]
+            result.new_commits.append((sha, None))
+
+    if not new_raw_commits:
+        return results
+
+    with github_client.track() as stats:
+        commits_stats = get_commits_stats(repo_name, list(new_raw_commits.keys()))
+
+    logger.info('stats of %d commits of %s fetched with %s', len(new_raw_commits), repo_name, stats)
+
+    renderer = render.repo_renderer(repo_name, repo_data.hashtag)
+    for result in results:
+        result.new_commits = [
+            (sha, renderer.commit(result.branch.name, new_raw_commits[sha], commits_stats.get(sha, None)))
+            for sha, _ in result.new_commits
+        ]
+
+    return results
+
+
+def commits_from_date():
+    # start from midnight, so the commits request doesn't change between cycles of the same day and can be a conditional one
+    return datetime.combine(date.today() - timedelta(days=config.jobs.github.commits_days_backwards), datetime.min.time())
+
+
+def post_repo_commits(repo_data, results):
+    """Save the new commits of a repo and queue their messages, branch by branch. results is the list of
+    BranchCommits returned by process_repo_commits()"""
+
+    repo_name = repo_data.path
+
+    result: BranchCommits
+    for result in results:
+        branch = result.branch
+
+        # the commits are saved together with their messages: the outbox worker will post them.
+        # A message is identified by the last commit it contains (and by its part, if that commit has been split)
+        renderer = render.repo_renderer(repo_name, repo_data.hashtag)
+        messages = []
+        for last_commit, part, text in renderer.messages([commit_text for _, commit_text in result.new_commits]):
+            key = 'commits:{}:{}'.format(repo_name, result.new_commits[last_commit][0])
+            messages.append((key if not part else '{}:{}'.format(key, part), text))
+
+        logger.info('%d new commits of %s/%s (%d messages), saving in db...', len(result.new_commits), repo_name,
+                    branch.name, len(messages))
+        shas = [sha for sha, _ in result.new_commits]
+        with write_transaction():
+            Commit.add_many(repo_name, shas)
+            for key, text in messages:
+                outbox.enqueue(repo_data, text, key=key)
+
+            # the next run will only ask what has been pushed after this head
+            BranchHead.replace(repository=repo_name, branch=branch.name, sha=branch.commit.sha).execute()
+            store_validators(result.response)
+
+        seen_commits.mark_saved(repo_name, shas)
 
 
 @u.logerrors
+@rate_limiter.accounted('commits_job', Priority.LOW)
 def commits_job(bot, _):
     logger.info('running commits job at %s...', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     if config.jobs.github.disable_commits:
         logger.info('commits job is disabled, exiting job')
         return
 
-    sender = Sender(bot, matrix_client)
+    from_date = commits_from_date()
 
-    from_date = datetime.now() - timedelta(days=config.jobs.github.commits_days_backwards)
+    tasks = [(repo_desc, repo_data) for repo_desc, repo_data in repos.repos.items() if repo_data.commits and (repo_data.chat_ids or repo_data.room_ids)]
+    tasks = repo_schedule.due('commits_job', tasks)
+    checked = set()
+    try:
+        with repo_locks.hold_many('commits', tasks) as tasks:
+            poll_commits(tasks, from_date, checked)
+    finally:
+        # the repos that have been skipped or have failed stay due, so the next run tries them again
+        repo_schedule.mark_checked('commits_job', checked)
 
-    for repo_desc, repo_data in repos.repos.items():
-        if not repo_data.commits or not repo_data.chat_id:
-            continue
+    logger.info('job finished')
 
-        repo_name = repo_data.path
-        logger.info('>>> loop: commits of %s', repo_desc)
 
-        try:
-            repo: Repository = g.get_repo(repo_name)
-        except UnknownObjectException as e:
-            logger.error('error while getting repo %s: %s', repo_name, str(e))
-            continue
+def poll_commits(tasks, from_date, checked):
+    # first we fetch the branches of every repo, then the commits of every branch, then we process every repo: each
+    # stage is a flat list of tasks so the pool is never waiting on itself.
+    # Do not let a broken repo stop the others: we raise the errors once the commits have been posted.
+    # The repos that have been polled are added to checked
+    snapshots = prefetch_repos(tasks, branches=True)
+    tasks = [(repo_desc, repo_data, snapshots.get(repo_data.path, None)) for repo_desc, repo_data in tasks]
 
-        branches: List[Branch] = list(repo.get_branches())
-        branches_count = len(branches)
-        if branches_count == 1:
-            logger.info('repo has only one branch')
-        else:
-            logger.info('repo has %d branches: %s', branches_count, ', '.join([b.name for b in branches]))
-
-        branch: Branch
-        for branch in branches:
-            if repo_data.branch and branch.name.lower() != repo_data.branch.lower():
-                logger.info("branch %s is not the tracked one, continuing...", branch.name)
-                continue
+    branches_results, branches_error, unfinished_branches = poller.run_all(fetch_branches, tasks, skip=RateLimited)
 
-            if repo_data.get('ignored_branches', None) and branch.name in repo_data.ignored_branches:
-                logger.info("branch %s is ignored, continuing...", branch.name)
-                continue
+    branch_tasks, branches_responses = [], []
+    for (repo_desc, repo_data, _), (response, branches) in branches_results:
+        branches_responses.append((repo_data.path, response))
+        for branch, last_sha in branches:
+            branch_tasks.append((repo_desc, repo_data, branch, last_sha, from_date))
 
-            if branch.name.startswith("dependabot"):
-                logger.info("ignoring branch %s: dependabot branch", branch.name)
-                continue
+    commits_results, commits_error, unfinished_commits = poller.run_all(fetch_branch_commits, branch_tasks,
+                                                                        skip=RateLimited)
 
-            logger.info('getting commits of %s/%s', repo_name, branch.name)
+    repos_commits = OrderedDict()
+    for (repo_desc, repo_data, branch, _, _), (response, raw_commits) in commits_results:
+        if repo_desc not in repos_commits:
+            repos_commits[repo_desc] = (repo_desc, repo_data, [])
 
-            commits = repo.get_commits(since=from_date, sha=branch.commit.sha)
-            logger.info('fetched %d total commits since %s (%d days ago)', len(list(commits)),
-                        from_date.strftime("%Y-%m-%d %H:%M:%S"),
-                        config.jobs.github.commits_days_backwards)
+        repos_commits[repo_desc][2].append((branch, response, raw_commits))
 
-            combined_message = ''
+    unfinished_repos, process_error = [], None
+    try:
+        for (repo_desc, repo_data, _), results in poller.fan_out(process_repo_commits, list(repos_commits.values()),
+                                                                 skip=RateLimited, unfinished=unfinished_repos):
+            if results:
+                post_repo_commits(repo_data, results)
+    except poller.PollerError as e:
+        process_error = e
+
+    # repos with a branch that has not been fetched or processed (e.g. rate limited) must list their branches
+    # again on the next run, or the branches that moved would look unchanged
+    incomplete = set(task[1].path for task in unfinished_commits + unfinished_repos)
+
+    if not commits_error:
+        # all the branches have been processed: the next run can skip the repos whose branches didn't move
+        for repository, response in branches_responses:
+            if repository in incomplete:
+                logger.info('not all the branches of %s have been processed: not saving the branches validators',
+                            repository)
+                continue
 
-            # reverse commits order
-            commits: List[GithubCommit] = [commit for commit in commits]
-            for commit in reversed(commits):
-                try:
-                    Commit.get(Commit.repository == repo_name, Commit.sha == commit.sha)
-                    logger.info('commit %s is already saved in db, continuing...', commit.sha)
-                    continue
-                except DoesNotExist:
-                    logger.info('commit %s is new, saving in db...', commit.sha)
-                    Commit.create(repository=repo_name, sha=commit.sha)
-
-                single_commit_text = NEW_COMMIT_STRING.format(
-                    branch_url='{}/tree/{}'.format(repo.html_url, branch.name),
-                    repo_name='{}/{}'.format(repo.full_name, branch.name),
-                    commit_message=escape(commit.commit.message),
-                    commit_url=commit.html_url,
-                    commit_sha=commit.sha[:7],
-                    # use only the first 7 characters
-                    # https://stackoverflow.com/questions/18134627/how-much-of-a-git-sha-is-generally-considered-necessary-to-uniquely-identify-a
-                    n_files=len(commit.files),
-                    commit_additions=commit.stats.additions,
-                    commit_deletions=commit.stats.deletions,
-                )
-
-                if (len(combined_message) + len(single_commit_text)) > MAX_MESSAGE_LENGTH:
-                    logger.info('combined text reached max length: sending commit message...')
-                    combined_message += '\n\n#{}'.format(repo_data.hashtag)
-                    sender.send_message(repo_data, combined_message)
-                    combined_message = ''
-
-                combined_message = '{}\n\n{}'.format(combined_message, single_commit_text)
-
-            logger.info('sending commit message after the loop (if not empty)...')
-            if combined_message.strip():
-                combined_message = append_hashtag(combined_message, repo_data.hashtag)
-                sender.send_message(repo_data, combined_message)
-            else:
-                logger.info('...it\'s empty')
-
-            time.sleep(3)
+            store_validators(response)
 
-    logger.info('job finished')
+    incomplete.update(task[1].path for task in unfinished_branches)
+    checked.update(repo_data.path for _, repo_data, _ in tasks if repo_data.path not in incomplete)
+
+    if branches_error or commits_error or process_error:
+        raise branches_error or commits_error or process_error
 
 
 @u.logerrors
+@rate_limiter.accounted('assets_job', Priority.HIGH)
 def assets_job(bot, _):
     logger.info('running assets job at %s...', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     if config.jobs.github.disable_assets:
@@ -276,115 +629,115 @@ def assets_job(bot, _):
     # assets job: don't send messages to Matrix
     sender = Sender(bot, matrix_client=None)
 
-    for repo_desc, repo_data in repos.repos.items():
-        if not repo_data.releases or not repo_data.assets or not repo_data.chat_id:
-            continue
+    tracked_repos = [(repo_desc, repo_data) for repo_desc, repo_data in repos.repos.items()
+                     if repo_data.releases and repo_data.assets and repo_data.chat_ids]
 
-        repo_name = repo_data.path
-        logger.info('extracting latest release record for %s...', repo_desc)
-        query = (
-            Release.select()
-            .where(Release.repository == repo_name, Release.added_on.is_null(False))
-            .order_by(Release.added_on.desc())
-            .limit(1)
-        )
+    # the latest release of every repo, if not checked yet and old enough, with one query for all the repos.
+    # Not all the repos have assets_timedelta: it's the time to wait after a release before checking the assets
+    releases_to_check = Release.latest_to_check({
+        repo_data.path: repo_data.get('assets_timedelta', config.jobs.github.assets_timedelta)
+        for _, repo_data in tracked_repos
+    })
+    logger.info('%d repos out of %d have a release whose assets have to be checked', len(releases_to_check),
+                len(tracked_repos))
 
-        if not query:
-            logger.info('no release found for repo %s, continuing to next repo', repo_name)
+    assets_tasks = []
+    for repo_desc, repo_data in tracked_repos:
+        repo_name = repo_data.path
+        release = releases_to_check.get(repo_name, None)
+        if not release:
             continue
 
-        release = query[0]
-
         logger.info('repo %s latest release: %d, added on: %s', repo_name, release.release_id, str(release.added_on))
-        if release.checked:
-            logger.info('we already checked release %d of repo %s, continuing to next repo', release.release_id,
-                        repo_name)
-            continue
-
-        # not all the repo have that attribute
-        assets_timedelta = repo_data.get('assets_timedelta', config.jobs.github.assets_timedelta)
 
-        # wait at least an hour before checking the assets
-        tdelta = datetime.now() - release.added_on
-        seconds_since_release = tdelta.total_seconds()
-        if seconds_since_release < assets_timedelta:
-            logger.info('time check: too soon to check assets, elapsed seconds: %d of %d', seconds_since_release, assets_timedelta)
-            continue
-
-        logger.info('time check: time to check assets, elapsed seconds: %d of %d', seconds_since_release, assets_timedelta)
+        logger.info('getting github release object...')
+        try:
+            raw_release = github_client.get('/repos/{}/releases/{}'.format(repo_name, release.release_id))
+        except RateLimited as e:
+            logger.warning('%s: the remaining releases will be checked during the next run', str(e))
+            break
+        except UnknownObjectException as e:
+            logger.error('error while getting release %d of repo %s: %s', release.release_id, repo_name, str(e))
+            raw_release = None
 
         # mark the release as checked. We will check later whether to send download urls/files according to config
         logger.info('marking release as checked...')
         release.checked = True
         release.save()
 
-        logger.info('getting github repo object...')
-        try:
-            repo = g.get_repo(repo_name)
-        except UnknownObjectException as e:
-            logger.error('error while getting repo %s: %s', repo_name, str(e))
+        if not raw_release:
             continue
 
-        logger.info('getting github release object...')
-        gh_release = repo.get_release(release.release_id)
-
-        logger.info('getting release assets...')
-        assets = gh_release.get_assets()
-        logger.info('%d assets found', len(list(assets)))
+        gh_release = g.create_from_raw_data(GitRelease.GitRelease, raw_release)
 
-        assets_urls_list = []
-        for asset in assets:
-            assets_urls_list.append(ASSET_STRING.format(
-                asset_download=asset.browser_download_url,
-                asset_label=asset.label or 'no label'
-            ))
+        # the assets are part of the release payload: no need to request (and paginate) them again
+        assets = gh_release.assets
+        logger.info('%d assets found', len(assets))
 
-        if not assets_urls_list:
+        renderer = render.repo_renderer(repo_data.path, repo_data.hashtag)
+        assets_list_text = renderer.assets_list(gh_release)
+        if not assets_list_text:
             logger.info('no asset to send, continuing to new repo...')
             continue
 
-        assets_list_text = '<b>Assets for release</b> <code>{}</code> <b>of {}</b>:\n\n{}'.format(
-            gh_release.tag_name,
-            repo_data.path,
-            '\n'.join(assets_urls_list)
-        )
-        assets_list_text = append_hashtag(assets_list_text, repo_data.hashtag)
-        assets_message, _ = sender.send_message(repo_data, assets_list_text)
+        # the files are sent as replies to the (first) assets list message of every chat
+        assets_messages = []
+        for chat_id in repo_data.chat_ids:
+            sent = []
+            for _, _, text in renderer.messages([assets_list_text]):
+                try:
+                    sent.append(sender.send_telegram(chat_id, text))
+                except TelegramError as e:
+                    sender.report_error(e, text)
+                    break
+
+            if sent:
+                assets_messages.append(sent[0])
+
+        if not assets_messages:
+            continue
 
         if not repo_data.asset_files:
             logger.info('skipping assets sending as per configuration (release has been marked as checked)')
             continue
 
-        for asset in assets:
-            logger.info('downloading asset %s...', asset.name)
-            try:
-                file_path = u.download_to_file(asset.browser_download_url, asset.name)
-            except Exception as e:
-                logger.error('error while downloading asset %s: %s', asset.name, str(e), exc_info=True)
-                continue
+        assets_tasks.append((repo_desc, release, gh_release, assets_messages))
 
-            try:
-                md5, sha1 = u.get_md5_sha1(file_path)
-            except Exception as e:
-                logger.error('error while generating md5/sha1 for asset %s: %s', asset.name, str(e), exc_info=True)
-                continue
+    # the assets of different releases are downloaded and sent at the same time
+    _, assets_error, _ = poller.run_all(send_release_assets, assets_tasks, pool=release_executor)
+    if assets_error:
+        raise assets_error
 
-            caption = CAPTION.format(md5=md5, sha1=sha1, asset_label=asset.label or 'non-labeled asset')
-            logger.info('sending asset %s...', asset.name)
-            try:
-                with open(file_path, 'rb') as f:
-                    assets_message.reply_document(f, caption=caption, parse_mode=ParseMode.HTML, timeout=300)
-            except Exception as e:
-                logger.error('error while sending the asset %s: %s', asset.name, str(e), exc_info=True)
-                continue
+    logger.info('job finished')
 
-            logger.info('removing file %s...', file_path)
-            os.remove(file_path)
 
-        release.sent = True
-        release.save()
+def send_release_assets(repo_desc, release, gh_release, assets_messages):
+    # asset name -> messages already sent, so a retry doesn't post the asset again in the same chat
+    sent_messages = {}
 
-    logger.info('job finished')
+    def send(asset, document, md5, sha1):
+        caption = CAPTION.format(md5=md5, sha1=sha1, asset_label=asset.label or 'non-labeled asset')
+        sent = sent_messages.setdefault(asset.name, [])
+        for assets_message in assets_messages[len(sent):]:
+            if sent:
+                # the file is uploaded only once, the other chats get its file_id
+                document = sent[0].document.file_id
+
+            logger.info('sending asset %s in %s...', asset.name, assets_message.chat_id)
+            sent.append(assets_message.reply_document(document, filename=asset.name, caption=caption,
+                                                      parse_mode=ParseMode.HTML, timeout=300))
+
+        return sent[0]
+
+    failed = send_assets(gh_release.assets, send, file_prefix='{}_'.format(release.release_id))
+    if failed:
+        logger.error('%s: %d assets of release %s could not be sent: %s', repo_desc, len(failed), gh_release.tag_name,
+                     ', '.join(asset.name for asset in failed))
+
+    release.sent = True
+    release.save()
+
+    return release
 
 
 @u.logerrors
@@ -406,7 +759,7 @@ def new_beta_job(bot, _):
     logger.info('last posted build: %d', latest_build_number)
 
     logger.info('executing request...')
-    page_content = requests.get(config.jobs.beta.url)
+    page_content = connections.session.get(config.jobs.beta.url)
     tree = html.fromstring(page_content.content)
 
     version_string = tree.xpath('/html/body/div[1]/div[2]/div/div[1]/div/div[3]/div[6]/h3')[0].text
@@ -430,18 +783,9 @@ def new_beta_job(bot, _):
     soup = BeautifulSoup(page_content.text, 'html.parser')
     download_url = u.bs_find_first(soup, 'a')
 
-    apk_path = u.download_to_file(download_url, apk_name)
+    apk_path, md5, sha1 = u.download_to_file(download_url, apk_name)
     logger.info('apk_path: %s', apk_path)
 
-    logger.info('getting md5/sha1...')
-    md5, sha1 = None, None
-    try:
-        md5, sha1 = u.get_md5_sha1(apk_path)
-    except Exception as e:
-        error_string = str(e)
-        logger.error('error while getting md5/sha1: %s', error_string, exc_info=True)
-        bot.send_message(config.telegram.admins[0], 'Error while generating md5/sha1: ' + error_string)
-
     caption = NEW_BETA_CAPTION.format(
         app_version=app_version,
         build_number=build_number
@@ -481,11 +825,21 @@ def new_beta_job(bot, _):
     logger.info('job finished')
 
 
+@u.logerrors
+def maintenance_job(bot, _):
+    logger.info('running database maintenance at %s...', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+    maintenance.run_maintenance()
+
+    logger.info('job finished')
+
+
 JOBS_CALLBACKS = (
     releases_job,
     commits_job,
     assets_job,
-    new_beta_job
+    new_beta_job,
+    maintenance_job
 )
 
 
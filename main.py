@@ -8,8 +8,22 @@ from telegram.ext import CommandHandler
 from telegram.ext import Filters
 
 from config import config
+from connections import pool_metrics
+from github_api import rate_limiter
+from database import OutboxMessage
+from database import OutboxStatus
+from database import maintenance
 from jobs import JOBS_CALLBACKS
+from jobs import matrix_client
+from jobs import releases_job
+from jobs import commits_job
+from jobs import maintenance_job
+from sender import Sender
+import outbox
+import schedule
+from runner import job_runner
 import utils as u
+import webhooks
 
 
 def load_logging_config(config_file_path='logging.json'):
@@ -38,15 +52,52 @@ def delete_downloads(_, update):
 def send_db(_, update):
     logger.info('sending_db')
 
+    # the recent changes are in the wal file
+    if not maintenance.checkpoint():
+        update.message.reply_text('The database is busy, the file might not include the latest changes')
+
     with open(config.database.filename, 'rb') as f:
         update.message.reply_document(f)
 
 
+@u.restricted
+def send_stats(_, update):
+    logger.info('stats')
+
+    outbox_counts = OutboxMessage.count_by_destination([OutboxStatus.PENDING, OutboxStatus.FAILED])
+    outbox_lines = ['{} {}: {} pending, {} failed'.format(
+        service,
+        chat_id,
+        counts.get(OutboxStatus.PENDING, 0),
+        counts.get(OutboxStatus.FAILED, 0)
+    ) for (service, chat_id), counts in sorted(outbox_counts.items())]
+
+    schedule_lines = []
+    for job_name in ('releases_job', 'commits_job'):
+        next_due = schedule.repo_schedule.next_due(job_name)
+        if next_due:
+            schedule_lines.append('{}: {} repos, {} due in the next hour'.format(
+                job_name, len(next_due), len([seconds for seconds in next_due.values() if seconds < 3600])
+            ))
+
+    text = 'GitHub rate limit: {}\nRequests by job: {}\n\nJobs:\n{}\n\nPolling:\n{}\n\nOutbox:\n{}\n\nHTTP pools:\n{}\n\nDatabase:\n{}'.format(
+        rate_limiter.status(),
+        ', '.join('{}: {}'.format(job, count) for job, count in rate_limiter.usage().items()) or 'none',
+        '\n'.join(job_runner.status()),
+        '\n'.join(schedule_lines) or 'no repo checked yet',
+        '\n'.join(outbox_lines) or 'nothing pending',
+        pool_metrics,
+        maintenance.report()
+    )
+
+    update.message.reply_text(text)
+
+
 @u.restricted
 def help_command(_, update):
     logger.info('help')
 
-    commands = ['/del', '/db', '/start']
+    commands = ['/del', '/db', '/stats', '/start']
 
     update.message.reply_text('Commands: {}'.format(', '.join(commands)))
 
@@ -54,15 +105,33 @@ def help_command(_, update):
 def main():
     updater = Updater(token=config.telegram.token, workers=config.telegram.run_async_workers)
     dispatcher = updater.dispatcher
-    jobs = updater.job_queue
+
+    # the jobs only queue their messages: the workers deliver them
+    outbox.start_workers(Sender(updater.bot, matrix_client))
+
+    webhooks_enabled = webhooks.webhooks_config.get('enabled', False) and webhooks.start_server()
 
     logger.info('registering %d scheduled jobs', len(JOBS_CALLBACKS))
     for callback in JOBS_CALLBACKS:
-        jobs.run_repeating(callback, interval=config.jobs.run_every, first=config.jobs.start_after)
+        interval = config.jobs.run_every
+        if webhooks_enabled and callback in (releases_job, commits_job):
+            # releases and pushes arrive with the webhooks: polling only catches the missed deliveries
+            interval = webhooks.webhooks_config.get('reconcile_every', 3600)
+        elif callback in (releases_job, commits_job):
+            # every run only polls the repos that are due: the most active ones are due every min_interval
+            interval = schedule.MIN_INTERVAL
+        elif callback is maintenance_job:
+            interval = config.database.get('maintenance_every', 86400)
+
+        job_runner.run_repeating(callback, interval=interval, first=config.jobs.start_after)
+
+    # every job runs on its own worker: a long commits run doesn't delay the assets job
+    job_runner.start(updater.bot)
 
     # dispatcher.add_handler(MessageHandler(~Filters.private & ~Filters.group & Filters.text, on_channel_post))
     dispatcher.add_handler(CommandHandler(['del'], delete_downloads, filters=Filters.private))
     dispatcher.add_handler(CommandHandler(['db'], send_db, filters=Filters.private))
+    dispatcher.add_handler(CommandHandler(['stats'], send_stats, filters=Filters.private))
     dispatcher.add_handler(CommandHandler(['start', 'help'], help_command, filters=Filters.private))
 
     logger.info('starting polling loop as @%s (run_async workers: %d)...', updater.bot.username, config.telegram.run_async_workers)
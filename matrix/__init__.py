@@ -1,2 +1,4 @@
 from .matrix import Matrix
 from .matrix import FakeMatrix
+from .matrix import MatrixError
+from .matrix import MatrixRateLimited
@@ -1,14 +1,17 @@
 import logging
+import threading
+import uuid
+from urllib.parse import quote
 
-from matrix_client.client import MatrixClient
-from matrix_client.api import MatrixHttpApi
-
+import connections
 from config import config
 
 logger = logging.getLogger(__name__)
 
 # room_id = "!MZJhJgkhKDpxLvTxXe:matrix.org"
 
+API_PATH = '/_matrix/client/r0'
+
 
 class MsgType:
     # https://matrix.org/docs/spec/r0.0.1/client_server.html#m-room-message-msgtypes
@@ -22,18 +25,102 @@ class MsgType:
     AUDIO = 'm.audio'
 
 
+class MatrixError(Exception):
+    def __init__(self, status_code, errcode, error):
+        self.status_code = status_code
+        self.errcode = errcode
+        super(MatrixError, self).__init__('{} {}: {}'.format(status_code, errcode, error))
+
+
+class MatrixRateLimited(MatrixError):
+    def __init__(self, status_code, errcode, error, retry_after):
+        self.retry_after = retry_after
+        super(MatrixRateLimited, self).__init__(status_code, errcode, error)
+
+
 class Matrix:
+    """Client-server API client on the shared HTTP pools.
+
+    The access token is saved in matrix.token_file, so restarting the bot doesn't log in again (creating a new
+    device every time). Messages are sent with a transaction id: sending again the same transaction id is a
+    no-op for the homeserver, so a request that timed out can be retried safely"""
+
     def __init__(self):
+        self._server = config.matrix.server.rstrip('/')
+        self._token_file = config.matrix.get('token_file', 'matrix_token.txt')
+        self._session = connections.new_session()
+        self._lock = threading.Lock()
+
+        self._token = self._load_token() or self._login()
+
+    def _load_token(self):
+        try:
+            with open(self._token_file, 'r') as f:
+                token = f.read().strip()
+        except FileNotFoundError:
+            return None
+
+        logger.info('using the saved Matrix access token')
+        return token or None
+
+    def _login(self):
         logger.info('logging in to Matrix as %s', config.matrix.username)
 
-        self._client = MatrixClient(config.matrix.server)
-        self._token = self._client.login(username=config.matrix.username, password=config.matrix.password, sync=False)
-        self._api = MatrixHttpApi(config.matrix.server, self._token)
+        response = self._session.post(self._server + API_PATH + '/login', json=dict(
+            type='m.login.password',
+            identifier=dict(type='m.id.user', user=config.matrix.username),
+            password=config.matrix.password
+        ))
+        token = self._check(response)['access_token']
+
+        with open(self._token_file, 'w+') as f:
+            f.write(token)
+
+        return token
+
+    @staticmethod
+    def _check(response):
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+
+        if response.status_code < 400:
+            return data
+
+        errcode, error = data.get('errcode', None), data.get('error', response.text)
+        if response.status_code == 429:
+            raise MatrixRateLimited(response.status_code, errcode, error, data.get('retry_after_ms', 5000) / 1000)
+
+        raise MatrixError(response.status_code, errcode, error)
+
+    def _request(self, method, path, json=None):
+        token = self._token
+        response = self._session.request(method, self._server + API_PATH + path, json=json, headers={
+            'Authorization': 'Bearer {}'.format(token)
+        })
+
+        if response.status_code == 401:
+            # the saved token is not valid anymore (e.g. the session has been logged out)
+            with self._lock:
+                if self._token == token:
+                    self._token = self._login()
+
+            response = self._session.request(method, self._server + API_PATH + path, json=json, headers={
+                'Authorization': 'Bearer {}'.format(self._token)
+            })
+
+        return self._check(response)
+
+    def _send(self, room_id, content, txn_id=None):
+        path = '/rooms/{}/send/m.room.message/{}'.format(quote(room_id, safe=''), quote(txn_id or uuid.uuid4().hex, safe=''))
+
+        return self._request('PUT', path, json=content)
 
-    def send_text(self, room_id, text):
-        self._api.send_message(room_id, text)
+    def send_text(self, room_id, text, txn_id=None):
+        return self._send(room_id, dict(body=text, msgtype=MsgType.TEXT), txn_id=txn_id)
 
-    def send_notice_html(self, room_id, text):
+    def send_notice_html(self, room_id, text, txn_id=None):
         content = dict(
             body=text,
             format='org.matrix.custom.html',
@@ -41,9 +128,9 @@ class Matrix:
             msgtype=MsgType.NOTICE
         )
 
-        self._api.send_message_event(room_id, event_type='m.room.message', content=content)
+        return self._send(room_id, content, txn_id=txn_id)
 
-    def send_text_html(self, room_id, text):
+    def send_text_html(self, room_id, text, txn_id=None):
         content = dict(
             body=text,
             format='org.matrix.custom.html',
@@ -51,10 +138,10 @@ class Matrix:
             msgtype=MsgType.TEXT
         )
 
-        self._api.send_message_event(room_id, event_type='m.room.message', content=content)
+        return self._send(room_id, content, txn_id=txn_id)
 
-    def send_notice(self, room_id, text):
-        self._api.send_notice(room_id, text)
+    def send_notice(self, room_id, text, txn_id=None):
+        return self._send(room_id, dict(body=text, msgtype=MsgType.NOTICE), txn_id=txn_id)
 
 
 class FakeMatrix:
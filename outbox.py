@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+
+from telegram.error import BadRequest
+from telegram.error import RetryAfter
+
+from config import config
+from database import OutboxMessage
+from database import OutboxStatus
+from database import Release
+from database import write_transaction
+from matrix import MatrixError
+from matrix import MatrixRateLimited
+from sender import Sender
+from sender import Service
+import render
+
+logger = logging.getLogger(__name__)
+
+delivery_config = config.get('delivery', {})
+
+PER_CHAT_INTERVAL = delivery_config.get('per_chat_interval', 3)
+GLOBAL_INTERVAL = 1.0 / delivery_config.get('global_rate', 20)
+MAX_ATTEMPTS = delivery_config.get('max_attempts', 10)
+CONCURRENCY = delivery_config.get('concurrency', 4)
+
+# backoff after a failed attempt: BACKOFF * 2^attempts seconds, up to MAX_BACKOFF
+BACKOFF = 5
+MAX_BACKOFF = 900
+
+# max seconds between two passes
+MAX_IDLE = 5
+
+# one event per service, set when there is something new to send
+_wakeup = {Service.TELEGRAM: threading.Event(), Service.MATRIX: threading.Event()}
+
+
+def enqueue(repo, text, key, release_id=None, matrix=True):
+    """Queue a message for every destination of the repo (one row each, so every destination has its own
+    delivery status). key must identify the message within the repo: enqueuing the same key again (e.g. a job
+    retried after a crash) doesn't send the message twice"""
+
+    rows = [(Service.TELEGRAM, chat_id, text) for chat_id in repo.chat_ids]
+    if matrix and config.matrix.enabled and repo.room_ids:
+        # the Matrix variant is rendered once, not on every attempt
+        matrix_text = render.matrix_html(text)
+        rows.extend((Service.MATRIX, room_id, matrix_text) for room_id in repo.room_ids)
+
+    OutboxMessage.add_many([dict(
+        key='{}:{}:{}'.format(service, chat_id, key),
+        service=service,
+        chat_id=str(chat_id),
+        text=service_text,
+        repository=repo.path,
+        release_id=release_id
+    ) for service, chat_id, service_text in rows])
+
+    for service, _, _ in rows:
+        _wakeup[service].set()
+
+
+class OutboxWorker(threading.Thread):
+    """Delivers the queued messages of a service, so the jobs never wait for Telegram or Matrix, and a slow
+    service doesn't delay the other one.
+
+    - messages of the same chat are sent in the order they were queued, one every PER_CHAT_INTERVAL seconds
+    - up to CONCURRENCY chats are sent to at the same time, but at most one message every GLOBAL_INTERVAL seconds
+    - flood waits pause the chat (Telegram) or the whole service (Matrix). Other errors pause the service and
+      are retried with an exponential backoff up to MAX_ATTEMPTS times, so a struggling server is not flooded
+      with requests; bad requests are not retried. Failed messages are reported to the admins
+
+    Delivery is at least once: if the bot stops right after a message has been sent but before it has been
+    marked as sent, it will be sent again"""
+
+    def __init__(self, sender: Sender, service):
+        super(OutboxWorker, self).__init__(name='outbox-{}'.format(service), daemon=True)
+        self._sender = sender
+        self._service = service
+        self._chat_ready_at = {}  # chat_id -> time
+        self._service_ready_at = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix='outbox-{}'.format(service))
+
+    def run(self):
+        logger.info('%s outbox worker started', self._service)
+        while True:
+            try:
+                wait = self._deliver_pending()
+            except Exception as e:
+                logger.error('error in the %s outbox worker: %s', self._service, str(e), exc_info=True)
+                wait = MAX_IDLE
+
+            _wakeup[self._service].wait(wait)
+            _wakeup[self._service].clear()
+
+    def _deliver_pending(self):
+        """Send what can be sent now. Returns the seconds to wait before the next pass"""
+
+        wait = MAX_IDLE
+        ready = []
+        now = time.time()
+        for message in OutboxMessage.oldest_pending(self._service):
+            chat = message.chat_id
+            ready_at = max(message.next_attempt_on.timestamp(), self._chat_ready_at.get(chat, 0))
+            if ready_at > now:
+                wait = min(wait, ready_at - now)
+                continue
+
+            ready.append(message)
+
+        # chats are independent: send to up to CONCURRENCY of them at the same time
+        futures = []
+        for message in ready:
+            with self._lock:
+                service_wait = self._service_ready_at - time.time()
+                if service_wait > GLOBAL_INTERVAL:
+                    # the service has been paused by a failure
+                    wait = min(wait, service_wait)
+                    break
+
+                self._service_ready_at = max(self._service_ready_at, time.time()) + GLOBAL_INTERVAL
+
+            if service_wait > 0:
+                time.sleep(service_wait)
+
+            futures.append(self._executor.submit(self._deliver, message))
+
+        for future in futures:
+            future.result()
+
+        if futures:
+            wait = min(wait, PER_CHAT_INTERVAL)
+
+        return max(wait, 0)
+
+    def _deliver(self, message: OutboxMessage):
+        try:
+            message_id = self._sender.deliver(message.service, message.chat_id, message.text, key=message.key)
+        except RetryAfter as e:
+            logger.warning('%s %s: flood wait of %d seconds', message.service, message.chat_id, e.retry_after)
+            self._retry(message, e.retry_after, e)
+            return
+        except MatrixRateLimited as e:
+            logger.warning('matrix rate limit: pausing for %d seconds', e.retry_after)
+            self._pause(e.retry_after)
+            self._retry(message, e.retry_after, e)
+            return
+        except BadRequest as e:
+            self._fail(message, e)
+            return
+        except MatrixError as e:
+            if e.status_code < 500:
+                self._fail(message, e)
+            else:
+                self._backoff(message, e)
+            return
+        except Exception as e:
+            self._backoff(message, e)
+            return
+
+        logger.info('outbox message %d sent to %s %s', message.id, message.service, message.chat_id)
+        self._chat_ready_at[message.chat_id] = time.time() + PER_CHAT_INTERVAL
+        message.status = OutboxStatus.SENT
+        message.message_id = message_id
+        message.sent_on = datetime.now()
+        message.attempts += 1
+
+        with write_transaction():
+            message.save()
+
+            if message.release_id and message.service == Service.TELEGRAM:
+                Release.update(post_id=int(message_id)).where(
+                    Release.repository == message.repository, Release.release_id == message.release_id
+                ).execute()
+
+    def _backoff(self, message: OutboxMessage, error):
+        # probably a network error or an overloaded server: pause the whole service
+        delay = min(BACKOFF * 2 ** message.attempts, MAX_BACKOFF)
+        self._pause(delay)
+        self._retry(message, delay, error)
+
+    def _pause(self, seconds):
+        with self._lock:
+            self._service_ready_at = max(self._service_ready_at, time.time() + seconds)
+
+    def _retry(self, message: OutboxMessage, delay, error):
+        message.attempts += 1
+        if message.attempts >= MAX_ATTEMPTS:
+            self._fail(message, error)
+            return
+
+        logger.warning('outbox message %d to %s %s failed (attempt %d), retrying in %d seconds: %s', message.id,
+                       message.service, message.chat_id, message.attempts, delay, str(error))
+        message.next_attempt_on = datetime.now() + timedelta(seconds=delay)
+        message.save()
+
+    def _fail(self, message: OutboxMessage, error):
+        logger.error('outbox message %d to %s %s not sent: %s', message.id, message.service, message.chat_id, str(error))
+        message.status = OutboxStatus.FAILED
+        message.save()
+
+        try:
+            self._sender.report_error(error, message.text)
+        except Exception as e:
+            logger.error('error while reporting the failed message: %s', str(e), exc_info=True)
+
+
+def start_workers(sender: Sender):
+    services = [Service.TELEGRAM]
+    if config.matrix.enabled:
+        services.append(Service.MATRIX)
+
+    workers = [OutboxWorker(sender, service) for service in services]
+    for worker in workers:
+        worker.start()
+
+    return workers
@@ -0,0 +1,68 @@
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# one pool shared by all the jobs, so the concurrency limit is global and not per-job
+CONCURRENCY = config.jobs.get('concurrency', 8)
+executor = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix='poller')
+
+
+class PollerError(Exception):
+    pass
+
+
+def fan_out(func, tasks, skip=(), unfinished=None, pool=None):
+    """Run func(*args) for every args tuple in tasks on the shared pool (or on pool).
+
+    Results are yielded as (args, result) in the same order of tasks, no matter which one completes first,
+    so the caller can post them in the configured order. A failing task yields None as result: the exception
+    is logged and re-raised as PollerError only once every other result has been yielded.
+    Exceptions in skip (e.g. rate limits) only skip the task: they are not errors. The args of the skipped and
+    of the failed tasks are appended to the unfinished list, if passed"""
+
+    # tasks run in a copy of the caller's context (e.g. the job the GitHub requests are accounted to)
+    pool = pool or executor
+    futures = [(args, pool.submit(contextvars.copy_context().run, func, *args)) for args in tasks]
+    logger.info('%d %s tasks submitted to the %s pool', len(futures), func.__name__,
+                'polling' if pool is executor else 'dedicated')
+
+    errors = []
+    for args, future in futures:
+        try:
+            result = future.result()
+        except skip as e:
+            logger.warning('task %s (%s) skipped: %s', func.__name__, args[0], str(e))
+            result = None
+            if unfinished is not None:
+                unfinished.append(args)
+        except Exception as e:
+            logger.error('error while running task %s (%s): %s', func.__name__, args[0], str(e), exc_info=True)
+            errors.append('{} ({}): {}'.format(func.__name__, args[0], str(e)))
+            result = None
+            if unfinished is not None:
+                unfinished.append(args)
+
+        yield args, result
+
+    if errors:
+        raise PollerError('{} tasks failed: {}'.format(len(errors), '; '.join(errors)))
+
+
+def run_all(func, tasks, skip=(), pool=None):
+    """Like fan_out(), but waits for every task: returns the list of (args, result) with a result, the PollerError
+    (or None) so the caller can raise it after it processed the results, and the list of args of the tasks that have
+    been skipped or have failed"""
+
+    results, error, unfinished = [], None, []
+    try:
+        for args, result in fan_out(func, tasks, skip=skip, unfinished=unfinished, pool=pool):
+            if result is not None:
+                results.append((args, result))
+    except PollerError as e:
+        error = e
+
+    return results, error, unfinished
@@ -0,0 +1,271 @@
+import logging
+import re
+from functools import lru_cache
+from html import escape
+from html import unescape
+
+from telegram import MAX_MESSAGE_LENGTH
+
+logger = logging.getLogger(__name__)
+
+NEW_RELEASE_STRING = """<a href="{release_url}">New {repo_name} release</a>: \
+<code>{release_tag}</code> ({channel})
+{release_body}"""
+
+ASSET_STRING = '• <a href="{asset_download}">{asset_label}</a>'
+
+ASSETS_LIST_STRING = """<b>Assets for release</b> <code>{release_tag}</code> <b>of {repo_name}</b>:
+
+{assets}"""
+
+NEW_COMMIT_STRING = """<a href="{branch_url}">{repo_name}</a> • <a href="{commit_url}">{commit_sha}</a> • <i>{n_files} files, +{commit_additions}/-{commit_deletions}</i>
+{commit_message}"""
+
+NEW_COMMIT_STRING_NO_STATS = """<a href="{branch_url}">{repo_name}</a> • <a href="{commit_url}">{commit_sha}</a>
+{commit_message}"""
+
+# commits of the same message are separated by an empty line
+SEPARATOR = '\n\n'
+
+# a tag, an entity, a newline, a text run, or a stray "<"/"&"
+_TOKENS = re.compile(r'<(/?)(\w+)[^>]*>|&#?\w+;|\n|[^<&\n]+|[<&]')
+_TAGS = re.compile(r'<[^>]*>')
+
+
+def _units(text):
+    # Telegram counts the length in UTF-16 code units: emojis count two
+    return len(text.encode('utf-16-le')) // 2
+
+
+def visible_length(html_text):
+    """Length of the text as counted by Telegram against MAX_MESSAGE_LENGTH: after the entities have been parsed,
+    so tags don't count and "&lt;" is one character"""
+
+    return _units(unescape(_TAGS.sub('', html_text)))
+
+
+def matrix_html(html_text):
+    """Matrix variant of a Telegram HTML text: newlines are not preserved in formatted_body"""
+
+    return html_text.strip().replace('\n', '<br>')
+
+
+def _prefill(template, **values):
+    # fill some fields of a format template once, leaving the other ones to be filled for every message
+    for name, value in values.items():
+        template = template.replace('{' + name + '}', value.replace('{', '{{').replace('}', '}}'))
+
+    return template
+
+
+def _close(open_tags):
+    return ''.join('</{}>'.format(name) for name, _ in reversed(open_tags))
+
+
+def _reopen(open_tags):
+    return [tag for _, tag in open_tags]
+
+
+def split_html(html_text, limit):
+    """Split a text into pieces that are at most limit long (visible_length()), preferably after a newline in the
+    second half of the piece. Tags open at the end of a piece are closed, and opened again at the start of the next
+    one, so every piece is valid HTML"""
+
+    pieces = []
+    current, length = [], 0
+    open_tags = []  # (name, opening tag)
+    last_break = None  # (tokens in current, open tags, length) right after the last newline
+
+    def can_break():
+        # don't make pieces much shorter than they could be just to split after a newline
+        return last_break is not None and last_break[2] >= limit // 2
+
+    def flush():
+        nonlocal current, length, last_break
+        if can_break():
+            position, break_tags, break_length = last_break
+            pieces.append(''.join(current[:position]) + _close(break_tags))
+            current = _reopen(break_tags) + current[position:]
+            length -= break_length
+        else:
+            pieces.append(''.join(current) + _close(open_tags))
+            current, length = _reopen(open_tags), 0
+
+        last_break = None
+
+    for match in _TOKENS.finditer(html_text):
+        token = match.group(0)
+
+        if match.group(2):
+            if not match.group(1):
+                open_tags.append((match.group(2), token))
+            elif open_tags and open_tags[-1][0] == match.group(2):
+                open_tags.pop()
+
+            current.append(token)
+            continue
+
+        if token in ('<', '&'):
+            # invalid HTML, but it's better to send it than to drop it
+            token = escape(token)
+
+        while token:
+            token_length = visible_length(token)
+            if length + token_length <= limit:
+                current.append(token)
+                length += token_length
+                if token == '\n':
+                    last_break = (len(current), list(open_tags), length)
+                break
+
+            if length and (can_break() or token.startswith('&') or token == '\n'):
+                # entities and newlines can't be split, and text is not split if there's a newline to split at
+                flush()
+                continue
+
+            # cut the text run where the piece is full, after a space if possible
+            cut, cut_length = 0, 0
+            while cut < len(token):
+                char_length = 2 if ord(token[cut]) > 0xFFFF else 1
+                if length + cut_length + char_length > limit:
+                    break
+                cut, cut_length = cut + 1, cut_length + char_length
+
+            space = token.rfind(' ', 0, cut)
+            if space > cut // 2:
+                cut = space + 1
+
+            current.append(token[:cut])
+            length += _units(token[:cut])
+            token = token[cut:]
+            flush()
+
+    if length:
+        pieces.append(''.join(current) + _close(open_tags))
+
+    return pieces
+
+
+def pack(blocks, footer='', limit=MAX_MESSAGE_LENGTH):
+    """Join the blocks (HTML texts, e.g. one per commit) in as few messages as possible, every one with the footer
+    (e.g. the hashtag) and at most limit long. A block is split only if it doesn't fit in a message on its own.
+
+    Returns a list of (index of the last block in the message, part, text): part counts the messages ending with
+    the same block, which happens only when a block has been split"""
+
+    budget = limit - visible_length(footer)
+    separator_length = visible_length(SEPARATOR)
+
+    messages = []
+    current, length = [], 0
+
+    def flush(last_block):
+        messages.append((last_block, SEPARATOR.join(current) + footer))
+
+    for index, block in enumerate(blocks):
+        block = block.strip()
+        block_length = visible_length(block)
+
+        if current and length + separator_length + block_length > budget:
+            flush(index - 1)
+            current, length = [], 0
+
+        if block_length > budget:
+            # the first pieces are messages on their own, the last one can be followed by other blocks
+            logger.info('block %d is too long (%d characters): splitting it', index, block_length)
+            pieces = split_html(block, budget)
+            for piece in pieces[:-1]:
+                current = [piece.strip()]
+                flush(index)
+
+            block = pieces[-1].strip()
+            block_length = visible_length(block)
+            current = []
+
+        length += (separator_length if current else 0) + block_length
+        current.append(block)
+
+    if current:
+        flush(len(blocks) - 1)
+
+    # number the messages that end with the same block, so every message has its own key
+    numbered, parts = [], {}
+    for last_block, text in messages:
+        part = parts.get(last_block, 0)
+        parts[last_block] = part + 1
+        numbered.append((last_block, part, text))
+
+    return numbered
+
+
+class RepoRenderer:
+    """Renders the messages of a repo. The parts of the templates that only depend on the repo and on the branch
+    are filled once, so rendering a commit only formats the fields of the commit"""
+
+    def __init__(self, repo_name, hashtag):
+        self.repo_name = repo_name
+        self.footer = '{}#{}'.format(SEPARATOR, hashtag) if hashtag else ''
+        self._release_template = _prefill(NEW_RELEASE_STRING, repo_name=escape(repo_name))
+        self._assets_template = _prefill(ASSETS_LIST_STRING, repo_name=escape(repo_name))
+        self._commit_templates = {}  # branch -> (template with stats, template without stats)
+
+    def _branch_templates(self, branch_name):
+        if branch_name not in self._commit_templates:
+            branch_values = dict(
+                branch_url=escape('https://github.com/{}/tree/{}'.format(self.repo_name, branch_name)),
+                repo_name=escape('{}/{}'.format(self.repo_name, branch_name))
+            )
+            self._commit_templates[branch_name] = (
+                _prefill(NEW_COMMIT_STRING, **branch_values),
+                _prefill(NEW_COMMIT_STRING_NO_STATS, **branch_values)
+            )
+
+        return self._commit_templates[branch_name]
+
+    def commit(self, branch_name, raw_commit, commit_stats=None):
+        template, template_no_stats = self._branch_templates(branch_name)
+        text_kwargs = dict(
+            commit_message=escape(raw_commit['commit']['message']),
+            commit_url=escape(raw_commit['html_url']),
+            # use only the first 7 characters
+            # https://stackoverflow.com/questions/18134627/how-much-of-a-git-sha-is-generally-considered-necessary-to-uniquely-identify-a
+            commit_sha=raw_commit['sha'][:7],
+        )
+
+        if not commit_stats:
+            return template_no_stats.format(**text_kwargs)
+
+        n_files, additions, deletions = commit_stats
+        return template.format(n_files=n_files, commit_additions=additions, commit_deletions=deletions, **text_kwargs)
+
+    def release(self, release):
+        return self._release_template.format(
+            release_url=escape(release.html_url),
+            release_tag=escape(release.tag_name),
+            release_body='\n' + escape(release.body) if release.body else '',
+            channel='beta' if release.prerelease else 'stable'
+        )
+
+    def assets_list(self, release):
+        """Returns None if the release has no assets"""
+
+        if not release.assets:
+            return None
+
+        return self._assets_template.format(
+            release_tag=escape(release.tag_name),
+            assets='\n'.join(ASSET_STRING.format(
+                asset_download=escape(asset.browser_download_url),
+                asset_label=escape(asset.label or 'no label')
+            ) for asset in release.assets)
+        )
+
+    def messages(self, blocks):
+        """See pack(): the messages have the repo hashtag"""
+
+        return pack(blocks, footer=self.footer)
+
+
+@lru_cache(maxsize=None)
+def repo_renderer(repo_name, hashtag):
+    return RepoRenderer(repo_name, hashtag)
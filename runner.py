@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class RepoLocks:
+    """One lock per (kind, repository), so a repo is never processed by two runs at the same time (e.g. the
+    commits job and a push webhook), while different repos and different kinds of work don't wait for each other"""
+
+    def __init__(self):
+        self._held = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold_many(self, kind, tasks):
+        """Take the repos of tasks ((repo_desc, repo_data, ...) tuples) that are free, without waiting. Yields the
+        tasks whose repo has been taken: the busy ones are skipped. Nobody waits for a repo: a thread waiting for it
+        could be one of the workers the holder is waiting for"""
+
+        held_tasks, keys = [], set()
+        with self._lock:
+            for task in tasks:
+                key = (kind, task[1].path)
+                if key in self._held and key not in keys:
+                    logger.info('%s of %s: already being processed, skipping', kind, task[1].path)
+                    continue
+
+                keys.add(key)
+                held_tasks.append(task)
+
+            self._held.update(keys)
+
+        try:
+            yield held_tasks
+        finally:
+            self._release(keys)
+
+    def _release(self, keys):
+        with self._lock:
+            self._held.difference_update(keys)
+
+
+repo_locks = RepoLocks()
+
+
+class ScheduledJob:
+    def __init__(self, callback, interval, first=0.0):
+        self.callback = callback
+        self.name = callback.__name__
+        self.interval = interval
+        self.next_run = time.time() + first
+        self.running = False
+        self.runs = 0
+        self.coalesced = 0  # runs skipped because the previous one was still running
+        self.pending_since = None  # when the first coalesced run was due: it runs as soon as the current run ends
+        self.last_duration = None
+        self.last_delay = None  # seconds between when the run was due and when it started
+        self.max_delay = 0.0
+
+    def __str__(self):
+        if not self.runs:
+            return '{}: never run'.format(self.name)
+
+        return '{}: {} runs, last {:.1f}s (delay {:.1f}s, max {:.1f}s), {} coalesced{}'.format(
+            self.name,
+            self.runs,
+            self.last_duration or 0.0,
+            self.last_delay,
+            self.max_delay,
+            self.coalesced,
+            ', running' if self.running else ''
+        )
+
+
+class JobRunner(threading.Thread):
+    """Runs the jobs on their own workers, so a long job (e.g. commits) doesn't delay the others (e.g. assets).
+
+    A job never overlaps with itself: the runs that are due while it's still running are coalesced into a single
+    run, started as soon as the current one ends, instead of being queued. Run time and queue delay (how late a
+    run started compared to when it was due) of every job are recorded"""
+
+    def __init__(self):
+        super(JobRunner, self).__init__(name='job-runner', daemon=True)
+        self._bot = None
+        self._jobs = []
+        self._condition = threading.Condition()
+        self._executor = None
+
+    def run_repeating(self, callback, interval, first=0.0):
+        with self._condition:
+            self._jobs.append(ScheduledJob(callback, interval, first))
+            self._condition.notify()
+
+    def status(self):
+        with self._condition:
+            return [str(job) for job in self._jobs]
+
+    def start(self, bot):
+        self._bot = bot
+        self._executor = ThreadPoolExecutor(max_workers=max(len(self._jobs), 1), thread_name_prefix='job')
+        super(JobRunner, self).start()
+
+    def run(self):
+        logger.info('job runner started with %d jobs', len(self._jobs))
+        while True:
+            with self._condition:
+                now = time.time()
+                for job in self._jobs:
+                    if job.next_run > now:
+                        continue
+
+                    due_at = job.next_run
+                    # the next slot after now: missed slots are not run
+                    job.next_run += job.interval * (int((now - job.next_run) // job.interval) + 1)
+
+                    if job.running:
+                        logger.warning('%s is still running: coalescing the run due at %s', job.name,
+                                       time.strftime('%H:%M:%S', time.localtime(due_at)))
+                        job.coalesced += 1
+                        if job.pending_since is None:
+                            job.pending_since = due_at
+                        continue
+
+                    job.running = True
+                    self._executor.submit(self._run_job, job, due_at)
+
+                wait = min([job.next_run for job in self._jobs], default=now + 60) - time.time()
+                self._condition.wait(max(wait, 0))
+
+    def _run_job(self, job: ScheduledJob, due_at):
+        start = time.time()
+        delay = start - due_at
+        logger.info('running %s (queue delay: %.1f seconds)', job.name, delay)
+
+        try:
+            job.callback(self._bot, job)
+        except Exception as e:
+            # the jobs log their own errors, this should not happen
+            logger.error('uncaught error in %s: %s', job.name, str(e), exc_info=True)
+
+        duration = time.time() - start
+        logger.info('%s finished in %.1f seconds', job.name, duration)
+
+        with self._condition:
+            job.running = False
+            job.runs += 1
+            job.last_duration = duration
+            job.last_delay = delay
+            job.max_delay = max(job.max_delay, delay)
+
+            if job.pending_since is not None:
+                # all the runs missed while this one was running become a single run, late since the first one
+                job.next_run, job.pending_since = job.pending_since, None
+                self._condition.notify()
+
+
+job_runner = JobRunner()
@@ -0,0 +1,97 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+from config import config
+from database import Release
+from database import BranchHead
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = config.jobs.get('min_interval', config.jobs.run_every)
+MAX_INTERVAL = max(config.jobs.get('max_interval', 3600), MIN_INTERVAL)
+JITTER = config.jobs.get('interval_jitter', 0.1)
+
+# a repo is checked every (seconds since its last update) / IDLE_RATIO: one updated an hour ago every 5 minutes,
+# one updated 12 hours ago every hour
+IDLE_RATIO = 12
+
+
+def activity():
+    """Returns a dict repository -> datetime of its last recorded update (new release or branch moved)"""
+
+    last_activity = Release.last_added()
+    for repository, updated_on in BranchHead.last_updated().items():
+        if repository not in last_activity or updated_on > last_activity[repository]:
+            last_activity[repository] = updated_on
+
+    return last_activity
+
+
+def interval(last_activity, now=None):
+    """Seconds between two checks of a repo last updated at last_activity (None: never), within the bounds"""
+
+    if not last_activity:
+        return MAX_INTERVAL
+
+    idle_seconds = ((now or datetime.now()) - last_activity).total_seconds()
+    return min(max(idle_seconds / IDLE_RATIO, MIN_INTERVAL), MAX_INTERVAL)
+
+
+class RepoSchedule:
+    """When every repo is due to be checked again by a job.
+
+    The interval of a repo is computed from its activity every time the job runs, so an update found by
+    another job (or received with a webhook) makes the repo due sooner. The jitter is drawn when the repo is
+    checked, so repos that became due together drift apart instead of always hitting GitHub in the same run.
+    It only shortens the interval: a job running every MAX_INTERVAL seconds checks all the repos every time.
+    The schedule is kept in memory: after a restart every repo is checked on the first run"""
+
+    def __init__(self):
+        self._last_check = {}  # (job, repository) -> (timestamp, jitter factor)
+        self._lock = threading.Lock()
+
+    def due(self, job_name, tasks):
+        """Returns the tasks ((repo_desc, repo_data, ...) tuples) whose repo is due. They are not marked as checked:
+        call mark_checked() with the repos that have actually been polled"""
+
+        last_activity = activity()
+        now, now_dt = time.time(), datetime.now()
+
+        due_tasks = []
+        with self._lock:
+            for task in tasks:
+                repository = task[1].path
+                last_check, jitter = self._last_check.get((job_name, repository), (0.0, 1.0))
+                if last_check + interval(last_activity.get(repository, None), now_dt) * jitter > now:
+                    continue
+
+                due_tasks.append(task)
+
+        logger.info('%s: %d repos out of %d are due', job_name, len(due_tasks), len(tasks))
+
+        return due_tasks
+
+    def mark_checked(self, job_name, repositories):
+        """The repos have been polled: they are not due until their interval has passed. Repos that have been
+        skipped or have failed are not marked, so they are due again on the next run"""
+
+        now = time.time()
+        with self._lock:
+            for repository in repositories:
+                self._last_check[(job_name, repository)] = (now, random.uniform(1 - JITTER, 1))
+
+    def next_due(self, job_name):
+        """Returns a dict repository -> seconds until the repo is due (negative: overdue)"""
+
+        last_activity = activity()
+        now, now_dt = time.time(), datetime.now()
+
+        with self._lock:
+            return {repository: last_check + interval(last_activity.get(repository, None), now_dt) * jitter - now
+                    for (job, repository), (last_check, jitter) in self._last_check.items() if job == job_name}
+
+
+repo_schedule = RepoSchedule()
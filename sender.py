@@ -1,9 +1,7 @@
+import hashlib
 import logging
-import re
 from copy import deepcopy
 
-from telegram.error import BadRequest
-from telegram.error import TelegramError
 from telegram import ParseMode
 from telegram import Bot
 
@@ -15,6 +13,11 @@ from config import config
 logger = logging.getLogger(__name__)
 
 
+class Service:
+    TELEGRAM = 'telegram'
+    MATRIX = 'matrix'
+
+
 class Sender:
     def __init__(self, telegram_bot=None, matrix_client=None):
         self._tgbot: Bot = telegram_bot
@@ -28,51 +31,40 @@ class Sender:
             timeout=60
         )
 
-    def send_message(self, repo, text, telegram=True, matrix=True, additional_telegram_kwargs: [None, dict] = None):
-        sent_message_telegram, sent_message_matrix = None, None
-
-        if repo.chat_id and self._tgbot and telegram:
-            if config.jobs.github.test_chat_id:
-                chat_id = config.jobs.github.test_chat_id
-            else:
-                chat_id = repo.chat_id
-
-            kwargs = deepcopy(self._tg_kwargs)
-            if additional_telegram_kwargs:
-                for k, v in additional_telegram_kwargs.items():
-                    kwargs[k] = v
-
-            try:
-                sent_message_telegram = self._tgbot.send_message(chat_id, text, **kwargs)
-            except (BadRequest, TelegramError) as e:
-                self._telegram_exception(e, text)
-                return
-        else:
-            logger.info('(not posting on telegram)')
+    def send_telegram(self, chat_id, text, additional_telegram_kwargs: [None, dict] = None):
+        kwargs = deepcopy(self._tg_kwargs)
+        if additional_telegram_kwargs:
+            for k, v in additional_telegram_kwargs.items():
+                kwargs[k] = v
 
-        if repo.get('room_id', None) and self._matrix and matrix:
-            matrix_text = re.sub('\n', r'<br>', text.strip())  # replave \n with <br> and also strip original text
-            # logger.info(matrix_text)
+        return self._tgbot.send_message(chat_id, text, **kwargs)
 
-            try:
-                sent_message_matrix = self._matrix.send_text_html(repo.room_id, matrix_text)
-            except Exception as e:
-                self._matrix_exception(e)
-                return
-        else:
-            logger.info('(not posting on matrix)')
+    def send_matrix(self, room_id, text, txn_id=None):
+        # text is already the Matrix variant (render.matrix_html())
+        return self._matrix.send_text_html(room_id, text, txn_id=txn_id)
 
-        return sent_message_telegram, sent_message_matrix
+    def deliver(self, service, chat_id, text, key=None):
+        """Used by the outbox workers: errors are raised. Returns the id of the sent message.
+        key identifies the message, so Matrix can recognize a retry of a message it already received"""
 
-    def _telegram_exception(self, e: [BadRequest, TelegramError], text):
+        if service == Service.TELEGRAM:
+            return str(self.send_telegram(chat_id, text).message_id)
+        elif service == Service.MATRIX:
+            if not self._matrix:
+                raise ValueError('Matrix is not enabled')
+
+            txn_id = hashlib.sha1(key.encode()).hexdigest() if key else None
+            return self.send_matrix(chat_id, text, txn_id=txn_id).get('event_id', None)
+
+        raise ValueError('unknown service: {}'.format(service))
+
+    def report_error(self, e: Exception, text):
         if config.telegram.get('exceptions_log', None):
-            chat_id = config.telegram
+            chat_id = config.telegram.exceptions_log
         else:
             chat_id = config.telegram.admins[0]
 
-        logger.error('[tg] error while sending text: %s', e.message, exc_info=True)
-        self._tgbot.send_message(chat_id, 'Error while sending message: {}'.format(e.message))
+        error_message = getattr(e, 'message', None) or str(e)
+        logger.error('error while sending text: %s', error_message, exc_info=True)
+        self._tgbot.send_message(chat_id, 'Error while sending message: {}'.format(error_message))
         self._tgbot.send_message(chat_id, text)
-
-    def _matrix_exception(self, e):
-        logger.error('[matrix] error while sending text: %s', str(e), exc_info=True)
@@ -0,0 +1,73 @@
+import importlib.util
+import json
+import os
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# load the module on its own: importing the github_api package needs a config.toml
+_spec = importlib.util.spec_from_file_location('graphql', os.path.join(HERE, 'github_api', 'graphql.py'))
+graphql = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(graphql)
+
+PATHS = ['telegramdesktop/tdesktop', 'deleted/repo', 'DrKLO/Telegram']
+
+
+def load_response():
+    with open(os.path.join(HERE, 'fixtures', 'graphql_repos_response.json')) as f:
+        return json.load(f)
+
+
+class BuildReposQueryTest(unittest.TestCase):
+    def test_one_alias_per_repo(self):
+        query = graphql.build_repos_query(PATHS, releases=True, branches=True, release_ids=True)
+
+        for index, path in enumerate(PATHS):
+            owner, name = path.split('/')
+            self.assertIn('r{}: repository(owner: "{}", name: "{}")'.format(index, owner, name), query)
+
+        self.assertIn('releaseIds: releases(', query)
+        self.assertIn('refs(refPrefix: "refs/heads/"', query)
+        self.assertNotIn('releaseAssets', query)
+
+    def test_only_requested_fragments(self):
+        query = graphql.build_repos_query(PATHS, releases=False, branches=False, release_ids=True)
+
+        self.assertIn('releaseIds: releases(', query)
+        self.assertNotIn('refs(', query)
+        self.assertNotIn('tagName', query)
+
+
+class ParseReposResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshots = graphql.parse_repos_response(PATHS, load_response()['data'])
+
+    def test_not_found_repo_is_left_to_rest(self):
+        self.assertNotIn('deleted/repo', self.snapshots)
+
+    def test_too_many_branches_is_left_to_rest(self):
+        # refs.pageInfo.hasNextPage: the branches in the response are not all of them
+        self.assertNotIn('DrKLO/Telegram', self.snapshots)
+
+    def test_rest_payloads(self):
+        snapshot = self.snapshots['telegramdesktop/tdesktop']
+
+        self.assertEqual([release['tag_name'] for release in snapshot.releases], ['v5.2.3', 'v5.2.4'])
+        release = snapshot.releases[1]
+        self.assertEqual(release['id'], 172215089)
+        self.assertEqual(release['html_url'], 'https://github.com/telegramdesktop/tdesktop/releases/tag/v5.2.4')
+        self.assertTrue(release['prerelease'])
+        self.assertEqual(release['assets'], [])
+
+        self.assertEqual(snapshot.branches, [
+            dict(name='dev', commit=dict(sha='4f6a1e0c3d1b2a9e8f7d6c5b4a39281706f5e4d3')),
+            dict(name='master', commit=dict(sha='9c2e47b1a0d3f5e6c7b8a9d0e1f2a3b4c5d6e7f8')),
+        ])
+
+    def test_newest_release_id_by_creation_date(self):
+        # the newest release is not always the first one of the list
+        self.assertEqual(self.snapshots['telegramdesktop/tdesktop'].newest_release_id, 172215089)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ from html import escape
 
 from telegram import ParseMode
 
+import connections
 from config import config
 
 urllib3.disable_warnings()
@@ -16,32 +17,79 @@ logger = logging.getLogger(__name__)
 BUF_SIZE = 65536  # needed to calculate hashes: read files in 64kb chunks
 
 
-def get_md5_sha1(file_path):
-    md5 = hashlib.md5()
-    sha1 = hashlib.sha1()
-
+def _update_hashes(file_path, *hashes):
     with open(file_path, 'rb') as f:
         while True:
             data = f.read(BUF_SIZE)
             if not data:
                 break
-            md5.update(data)
-            sha1.update(data)
+            for h in hashes:
+                h.update(data)
 
-    return md5.hexdigest(), sha1.hexdigest()
 
+def download_to_file(url, file_name, size=None):
+    """Stream url to downloads/file_name in BUF_SIZE chunks, computing md5 and sha1 in the same pass.
 
-def download_to_file(url, file_name):
-    connection_pool = urllib3.PoolManager()
-    resp = connection_pool.request('GET', url)
+    The data is written to a .part file that is renamed once the download is complete. If a .part file is
+    already there (a previous attempt failed), only the missing bytes are requested with an HTTP Range header.
+    Pass the expected size, if known, to make sure a partial file is not resumed against a different file.
+    Returns (file_path, md5, sha1)"""
 
     file_path = os.path.join('downloads', file_name)
-    with open(file_path, 'wb') as f:
-        f.write(resp.data)
-
-    resp.release_conn()
-
-    return file_path
+    part_path = file_path + '.part'
+
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if size is not None and offset > size:
+        offset = 0
+
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+    resp = connections.session.get(url, headers=headers, stream=True)
+
+    if offset and resp.status_code == 416:
+        # the range starts at the end of the file: the partial file is complete only if it has the size of the file
+        # (the expected one, or the one in the "bytes */size" Content-Range of the response)
+        total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+        expected_size = size if size is not None else (int(total) if total.isdigit() else None)
+        if expected_size != offset:
+            resp.close()
+            logger.info('%s: the partial file can\'t be resumed, downloading it from scratch', file_name)
+            os.remove(part_path)
+            return download_to_file(url, file_name, size)
+
+    try:
+        if resp.status_code >= 400 and not (offset and resp.status_code == 416):
+            resp.raise_for_status()
+
+        md5 = hashlib.md5()
+        sha1 = hashlib.sha1()
+
+        content_range = resp.headers.get('Content-Range', '')
+        if offset and resp.status_code == 206 and content_range.startswith('bytes {}-'.format(offset)):
+            logger.info('resuming download of %s from byte %d', file_name, offset)
+            _update_hashes(part_path, md5, sha1)
+            mode = 'ab'
+        elif offset and resp.status_code == 416:
+            # the previous attempt downloaded everything but failed before the rename
+            logger.info('%s was already fully downloaded', file_name)
+            _update_hashes(part_path, md5, sha1)
+            mode = None
+        else:
+            # no partial file, or the server ignored the range: start from scratch
+            mode = 'wb'
+
+        if mode:
+            with open(part_path, mode) as f:
+                for chunk in resp.iter_content(BUF_SIZE):
+                    f.write(chunk)
+                    md5.update(chunk)
+                    sha1.update(chunk)
+    finally:
+        resp.close()
+
+    os.replace(part_path, file_path)
+
+    return file_path, md5.hexdigest(), sha1.hexdigest()
 
 
 def bs_find_first(soup, tag_to_find):
@@ -0,0 +1,258 @@
+import argparse
+import contextvars
+import hashlib
+import hmac
+import json
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from github import Branch
+from github import GitRelease
+
+from config import config
+from config import repos
+from database import BranchHead
+from github_api import rate_limiter
+from github_api import Priority
+import jobs
+from runner import repo_locks
+
+logger = logging.getLogger(__name__)
+
+webhooks_config = config.get('webhooks', {})
+
+# release actions that make a release visible
+RELEASE_ACTIONS = ('published', 'prereleased', 'released', 'created')
+
+# push payloads include at most 20 commits: bigger pushes are fetched through the API
+PUSH_MAX_COMMITS = 20
+
+# a repo that a job is processing is not waited for: the delivery is retried for that repo every BUSY_RETRY_DELAY
+# seconds, up to BUSY_RETRIES times. Then the reconcile run of the job will find what it missed
+BUSY_RETRY_DELAY = 30
+BUSY_RETRIES = 10
+
+# deliveries are processed on their own workers, not on the pool of the jobs: a job waits for its tasks on the pool
+# while it holds the locks of its repos
+executor = ThreadPoolExecutor(max_workers=webhooks_config.get('workers', 2), thread_name_prefix='webhook')
+
+
+def sign(secret, body):
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret, body, signature):
+    return bool(signature) and hmac.compare_digest(sign(secret, body), signature)
+
+
+def find_repos(full_name):
+    """Repos entries with the given path (GitHub doesn't care about the case)"""
+
+    full_name = full_name.lower()
+    return [(repo_desc, repo_data) for repo_desc, repo_data in repos.repos.items()
+            if repo_data.path.lower() == full_name and (repo_data.chat_ids or repo_data.room_ids)]
+
+
+def rest_commit(push_commit):
+    # a commit of a push payload, in the shape of the REST API commits
+    return dict(sha=push_commit['id'], html_url=push_commit['url'], commit=dict(
+        message=push_commit['message'],
+        committer=dict(date=push_commit.get('timestamp', None))
+    ))
+
+
+def on_release(repo_desc, repo_data, payload):
+    if not repo_data.releases:
+        return
+
+    raw_release = payload['release']
+    if payload.get('action', None) not in RELEASE_ACTIONS or raw_release.get('draft', False):
+        logger.info('%s: ignoring release %s (action: %s)', repo_desc, raw_release.get('tag_name', None), payload.get('action', None))
+        return
+
+    release = jobs.g.create_from_raw_data(GitRelease.GitRelease, raw_release)
+    jobs.post_new_releases([(repo_data, release)])
+
+
+def on_push(repo_desc, repo_data, payload):
+    if not repo_data.commits or payload.get('deleted', False) or not payload['ref'].startswith('refs/heads/'):
+        return
+
+    branch_name = payload['ref'][len('refs/heads/'):]
+    if not jobs.is_tracked_branch(repo_data, branch_name):
+        return
+
+    repo_name = repo_data.path
+    branch = jobs.g.create_from_raw_data(Branch.Branch, dict(name=branch_name, commit=dict(sha=payload['after'])))
+
+    head = BranchHead.get_or_none(BranchHead.repository == repo_name, BranchHead.branch == branch_name)
+    last_sha = head.sha if head else None
+    if last_sha == payload['after']:
+        logger.info('%s/%s: push already processed', repo_name, branch_name)
+        return
+
+    push_commits = payload.get('commits', [])
+    if last_sha == payload['before'] and not payload.get('forced', False) and len(push_commits) < PUSH_MAX_COMMITS:
+        # the payload has all the commits pushed since the last processed head, oldest first
+        response, raw_commits = None, [rest_commit(push_commit) for push_commit in push_commits]
+    else:
+        # unknown head, force-push or truncated payload: same requests as the commits job
+        response, raw_commits = jobs.fetch_branch_commits(repo_desc, repo_data, branch, last_sha, jobs.commits_from_date())
+
+    results = jobs.process_repo_commits(repo_desc, repo_data, [(branch, response, raw_commits)])
+    jobs.post_repo_commits(repo_data, results)
+
+
+# event -> (kind of the repo lock, handler): a repo is not processed by a webhook and by a job at the same time
+EVENT_HANDLERS = {
+    'release': ('releases', on_release),
+    'push': ('commits', on_push),
+}
+
+
+def handle_event(event, payload, repo_descs=None):
+    """Process a webhook payload with the same dedup/render code of the jobs, for all the tracked repos with the
+    payload repository (or only the ones in repo_descs). Returns the descs of the repos that have not been
+    processed because a job is processing them"""
+
+    repository = payload.get('repository', {}).get('full_name', None)
+    if event not in EVENT_HANDLERS or not repository:
+        return []
+
+    lock_kind, handler = EVENT_HANDLERS[event]
+
+    tracked_repos = find_repos(repository)
+    if repo_descs is not None:
+        tracked_repos = [(repo_desc, repo_data) for repo_desc, repo_data in tracked_repos if repo_desc in repo_descs]
+    if not tracked_repos:
+        logger.info('webhook %s of %s: repository not tracked', event, repository)
+        return []
+
+    busy = []
+    with rate_limiter.job('webhook_{}'.format(event), Priority.HIGH):
+        for repo_desc, repo_data in tracked_repos:
+            with repo_locks.hold_many(lock_kind, [(repo_desc, repo_data)]) as held:
+                if not held:
+                    busy.append(repo_desc)
+                    continue
+
+                logger.info('webhook %s of %s', event, repo_desc)
+                handler(repo_desc, repo_data, payload)
+
+    return busy
+
+
+def _process(event, delivery, payload, repo_descs=None, attempt=0):
+    try:
+        busy = handle_event(event, payload, repo_descs)
+    except Exception as e:
+        logger.error('error while processing the webhook delivery %s (%s): %s', delivery, event, str(e), exc_info=True)
+        return
+
+    if not busy:
+        return
+
+    if attempt >= BUSY_RETRIES:
+        logger.warning('webhook delivery %s (%s): %s still being processed by a job, leaving them to the reconcile run',
+                       delivery, event, ', '.join(busy))
+        return
+
+    logger.info('webhook delivery %s (%s): %s being processed by a job, retrying in %d seconds', delivery, event,
+                ', '.join(busy), BUSY_RETRY_DELAY)
+    timer = threading.Timer(BUSY_RETRY_DELAY, submit, args=(event, delivery, payload, busy, attempt + 1))
+    timer.daemon = True
+    timer.start()
+
+
+def submit(event, delivery, payload, repo_descs=None, attempt=0):
+    executor.submit(contextvars.copy_context().run, _process, event, delivery, payload, repo_descs, attempt)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def _reply(self, status_code, text=''):
+        body = text.encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.split('?')[0] != webhooks_config.get('path', '/github'):
+            self._reply(404, 'not found')
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not verify_signature(webhooks_config.get('secret', ''), body, self.headers.get('X-Hub-Signature-256', None)):
+            logger.warning('webhook with an invalid signature from %s', self.client_address[0])
+            self._reply(401, 'invalid signature')
+            return
+
+        event = self.headers.get('X-GitHub-Event', None)
+        delivery = self.headers.get('X-GitHub-Delivery', None)
+        if event == 'ping':
+            self._reply(200, 'pong')
+            return
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self._reply(400, 'invalid payload')
+            return
+
+        if event not in EVENT_HANDLERS:
+            self._reply(202, 'ignored')
+            return
+
+        # GitHub waits for the response at most 10 seconds: the payload is processed on the webhook workers
+        submit(event, delivery, payload)
+        self._reply(202, 'accepted')
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.client_address[0], format % args)
+
+
+def start_server():
+    if not webhooks_config.get('secret', None):
+        logger.error('webhooks.secret is empty: not starting the webhooks server')
+        return
+
+    address = (webhooks_config.get('host', '0.0.0.0'), webhooks_config.get('port', 8080))
+    server = ThreadingHTTPServer(address, WebhookHandler)
+    threading.Thread(target=server.serve_forever, name='webhooks', daemon=True).start()
+    logger.info('webhooks server listening on %s:%d%s', address[0], address[1], webhooks_config.get('path', '/github'))
+
+    return server
+
+
+def main():
+    # replay a recorded payload against a running bot, signed with the configured secret
+    parser = argparse.ArgumentParser()
+    parser.add_argument('event', help='GitHub event name, e.g. push or release')
+    parser.add_argument('payload', help='path of a recorded payload (json)')
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:{}{}'.format(
+        webhooks_config.get('port', 8080), webhooks_config.get('path', '/github')
+    ))
+    args = parser.parse_args()
+
+    with open(args.payload, 'rb') as f:
+        body = f.read()
+
+    import connections
+
+    response = connections.session.post(args.url, data=body, headers={
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': args.event,
+        'X-GitHub-Delivery': 'replay',
+        'X-Hub-Signature-256': sign(webhooks_config.get('secret', ''), body)
+    })
+    print(response.status_code, response.text)
+    sys.exit(0 if response.ok else 1)
+
+
+if __name__ == '__main__':
+    main()